@@ -1,43 +1,77 @@
 # -*— coding: utf-8 -*-
-import time, uuid
+import asyncio, time, uuid
 
-from orm import  Model, StringField, BooleanField, FloatField, TextField
+import ids
+from config import configs
+import orm
+from orm import  Model, StringField, BooleanField, FloatField, TextField, BigIntField
 
+# 主键及引用主键的列的类型,见configs.ids:
+#   bigint: 64位整数,由ids.next_id()生成,按时间递增,每个值只占8个字节
+#   string: 之前的varchar(50)字符串,用于还没有迁移的数据库
+ID_TYPE = configs.ids.type
+ids.configure(configs.ids.worker_id, warn=not configs.debug)
 
 def next_id():
+    if ID_TYPE == 'bigint':
+        return ids.next_id()
     return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
 
+def id_field(**kw):
+    if ID_TYPE == 'bigint':
+        return BigIntField(**kw)
+    return StringField(ddl='varchar(50)', **kw)
+
+# 启动时检查configs.ids.type与数据库中users.id列的类型是否一致
+# 不一致时find()无法转换已有的主键,所有的博客页面和会话cookie都会失效,因此直接拒绝启动;表还不存在时不检查
+@asyncio.coroutine
+def check_id_type():
+    column = yield from orm.column_type(User.__table__, User.__primary_key__)
+    if column is None:
+        return
+    actual = 'bigint' if column.startswith('bigint') else 'string'
+    if actual != ID_TYPE:
+        raise ValueError('configs.ids.type is %r but users.id is %s in the database, set configs.ids.type to %r in config_override.py.' % (ID_TYPE, column, actual))
+
 class User(Model):
     __table__ = 'users'
+    # 每个请求都会在cookie2user中按主键查询用户,同一轮事件循环中的查询合并为一条
+    __batch__ = True
+    # 输出json时口令显示为'******'
+    __hidden__ = ('passwd',)
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    id = id_field(primary_key=True, default=next_id)
+    email = StringField(ddl='varchar(50)', unique=True)
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = True
+    __batch__ = True
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = id_field(primary_key=True, default=next_id)
+    user_id = id_field(references='User', related_name='blogs')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
 
 class Comment(Model):
     __table__ = 'comments'
+    # get_blog按blog_id查询并按created_at排序
+    __indexes__ = [('blog_id', 'created_at')]
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = id_field(primary_key=True, default=next_id)
+    blog_id = id_field(references='Blog', related_name='comments')
+    user_id = id_field(references='User', related_name='comments')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
-    created_at = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
 
@@ -5,7 +5,14 @@
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
+
+# 用作json.dumps的default参数:Model对象通过toDict()转换为dict,其他对象(如Page)使用__dict__
+def json_default(o):
+    toDict = getattr(o, 'toDict', None)
+    if toDict is not None:
+        return toDict()
+    return o.__dict__
 
 # 第11天添加的Page
 class Page(object):
@@ -115,7 +122,111 @@ class Page(object):
     __repr__ = __str__
 
 
+# 基于游标的分页,配合Model.findAll的after/before参数使用(键集分页)
+# 游标是对排序列的值做编码后得到的字符串,客户端只需原样传回,不需要关心其内容
+def encode_cursor(direction, values):
+    '''
+    Encode direction ('n' or 'p') and key values as an opaque cursor string.
+    >>> c = encode_cursor('n', [1461484800.5, 'abc'])
+    >>> decode_cursor(c)
+    ('n', [1461484800.5, 'abc'])
+    '''
+    s = json.dumps([direction, list(values)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    '''
+    Decode cursor string, raise APIValueError if the cursor is invalid.
+    '''
+    try:
+        s = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii')).decode('utf-8')
+        direction, values = json.loads(s)
+    except (ValueError, TypeError, UnicodeError):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    if direction not in ('n', 'p') or not isinstance(values, list):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    return direction, values
+
+class CursorPage(object):
+    '''
+    Cursor-based page object for display pages.
+    '''
+
+    def __init__(self, cursor=None, page_size=10, keys=('created_at', 'id')):
+        '''
+        Init Pagination by cursor, page_size and the key columns of ordering.
+        >>> p1 = CursorPage()
+        >>> p1.after, p1.before, p1.limit
+        (None, None, 11)
+        >>> p2 = CursorPage(encode_cursor('n', [100.0, 'a']))
+        >>> p2.after, p2.before
+        ([100.0, 'a'], None)
+        '''
+        self.page_size = page_size
+        self.keys = keys
+        self.after = None
+        self.before = None
+        # 多查询一条记录,用于判断在查询方向上是否还有下一页
+        self.limit = page_size + 1
+        if cursor:
+            direction, values = decode_cursor(cursor)
+            if len(values) != len(keys):
+                raise APIValueError('cursor', 'Invalid cursor.')
+            if direction == 'n':
+                self.after = values
+            else:
+                self.before = values
+        self.has_next = False
+        self.has_previous = False
+        self.next_cursor = None
+        self.prev_cursor = None
+
+    def paginate(self, items):
+        '''
+        Trim items fetched with limit and compute next and previous cursors.
+        >>> class Item(object):
+        ...     def __init__(self, i):
+        ...         self.created_at, self.id = float(i), str(i)
+        >>> p = CursorPage(page_size=2)
+        >>> [i.id for i in p.paginate([Item(3), Item(2), Item(1)])]
+        ['3', '2']
+        >>> p.has_next, p.has_previous
+        (True, False)
+        >>> decode_cursor(p.next_cursor)
+        ('n', [2.0, '2'])
+        >>> p = CursorPage(p.next_cursor, page_size=2)
+        >>> [i.id for i in p.paginate([Item(1)])]
+        ['1']
+        >>> p.has_next, p.has_previous
+        (False, True)
+        >>> decode_cursor(p.prev_cursor)
+        ('p', [1.0, '1'])
+        '''
+        items = list(items)
+        more = len(items) > self.page_size
+        if self.before is not None:
+            # 向前翻页时多出来的那条记录在最前面
+            if more:
+                items = items[1:]
+            self.has_previous = more
+            self.has_next = True
+        else:
+            if more:
+                items = items[:self.page_size]
+            self.has_next = more
+            self.has_previous = self.after is not None
+        if items:
+            if self.has_next:
+                self.next_cursor = encode_cursor('n', [getattr(items[-1], k) for k in self.keys])
+            if self.has_previous:
+                self.prev_cursor = encode_cursor('p', [getattr(items[0], k) for k in self.keys])
+        return items
 
+    def __str__(self):
+        return 'page_size: %s, after: %s, before: %s, has_next: %s, has_previous: %s' % (
+           self.page_size, self.after, self.before, self.has_next, self.has_previous
+        )
+    __repr__ = __str__
 
 
 if __name__=='__main__':
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 # Web App 骨架，基于aiohttp的app.py
-import logging; logging.basicConfig(level=logging.INFO)
+import logging
 
 import asyncio, os, json, time
 from datetime import datetime
@@ -10,7 +10,14 @@ from jinja2 import Environment, FileSystemLoader
 
 from config import configs
 
+# 先配置日志,之后导入的模块的日志也按configs.logging输出
+import logs
+logs.setup(configs.logging)
+
 import orm
+import search
+import Models
+from apis import json_default
 from coroweb import add_routes, add_static
 from handlers import cookie2user, COOKIE_NAME
 
@@ -44,28 +51,68 @@ def init_jinja2(app, **kw):
     # 给webapp设置模板
     app['__templating__'] = env
 
+_request_log = logs.getLogger('request')
+_auth_log = logs.getLogger('auth')
+_response_log = logs.getLogger('response')
+
 # 在正式处理之前打印日志
 @asyncio.coroutine
 def logger_factory(app, handler):
     @asyncio.coroutine
     def logger(request):
-        logging.info('Request: %s %s' % (request.method, request.path))
+        _request_log.info('request', method=request.method, path=request.path)
         # yield from asyncio.sleep(0.3)
         return (yield from handler(request))
     return logger
 
+# 为每个请求创建一个标识映射,请求内按主键重复加载的对象直接从内存中返回
+# 放在auth_factory之前,这样cookie2user加载的用户也会进入映射
+@asyncio.coroutine
+def identity_map_factory(app, handler):
+    @asyncio.coroutine
+    def identity_map(request):
+        request.__identity_map__ = orm.IdentityMap()
+        orm.bind_identity_map(request.__identity_map__)
+        try:
+            return (yield from handler(request))
+        finally:
+            orm.bind_identity_map(None)
+    return identity_map
+
+# 读己之写:请求写入过数据时设置一个短期的cookie,有效期内同一浏览器的后续请求(例如POST之后的重定向)也读主库
+# 没有配置副本时orm.written()总是返回0,不会设置cookie
+STICKY_COOKIE = 'awesticky'
+
+@asyncio.coroutine
+def sticky_factory(app, handler):
+    @asyncio.coroutine
+    def sticky(request):
+        # keep-alive连接上的请求可能共用一个Task,先清除上一个请求留下的标记,结束时也清除
+        orm.reset_sticky()
+        try:
+            if request.cookies.get(STICKY_COOKIE):
+                orm.read_primary()
+            r = yield from handler(request)
+            window = orm.written()
+            if window and isinstance(r, web.StreamResponse):
+                r.set_cookie(STICKY_COOKIE, '1', max_age=window, httponly=True)
+            return r
+        finally:
+            orm.reset_sticky()
+    return sticky
+
 # 请求头处理cookie
 @asyncio.coroutine
 def auth_factory(app, handler):
     @asyncio.coroutine
     def auth(request):
-        logging.info('check user: %s %s' % (request.method, request.path))
+        _auth_log.info('check user', method=request.method, path=request.path)
         request.__user__ = None
         cookie_str = request.cookies.get(COOKIE_NAME)
         if cookie_str:
             user = yield from cookie2user(cookie_str)
             if user:
-                logging.info('set current user: %s' % user.email)
+                _auth_log.info('set current user', email=user.email)
                 request.__user__ = user
         # 这里的not去掉,让用户可以正常登陆admin(之前是: not request.__user__.admin)->省缺值是False
         if request.path.startswith('/manage/') and (request.__user__ is None or request.__user__.admin):
@@ -80,10 +127,10 @@ def data_factory(app, handler):
         if request.method == "POST":
             if request.content_type.startswith('application/json'):
                 request.__data__ = yield from request.json()
-                logging.info('request json: %s' % str(request.__data__))
+                _request_log.info('request json', data=request.__data__)
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
                 request.__data__ = yield from request.post()
-                logging.info('request form: %s' % str(request.__data__))
+                _request_log.info('request form', data=request.__data__)
         return (yield from handler(request))
     return parse_data
 
@@ -100,7 +147,7 @@ def data_factory(app, handler):
 def response_factory(app, handler):
     @asyncio.coroutine
     def response(request):
-        logging.info("Response handler...")
+        _response_log.info('response', path=request.path)
         # 调用相应的Handler处理request
         r = yield from handler(request)
         # 如果响应结果为web.StreamResponse类,则直接把它作为相应返回
@@ -120,13 +167,18 @@ def response_factory(app, handler):
             resp = web.Response(body=r.encode('utf-8'))
             resp.content_type = 'text/html;charset=utf-8'
             return resp
+        # Model不再继承自dict,按json返回
+        if isinstance(r, orm.Model):
+            resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
+            resp.content_type = 'application/json;charset=utf-8'
+            return resp
         # 如果想以为字典
         if isinstance(r, dict):
             # 先检查'__template__'有没有key值
             template = r.get('__template__')
             # 如果没有,说明要返回json字符串,则包字典转换为json返回,对应的response类型设为json类型
             if template is None:
-                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
@@ -165,21 +217,29 @@ def datetime_filter(t):
     dt = datetime.fromtimestamp(t)
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
-@asyncio.coroutine
-def init(loop):
-    yield from orm.create_pool(loop=loop, **configs.db)
+# 创建web应用并注册中间件,模板,路由和静态文件,不依赖数据库配置,压测脚本(bench.py)也使用它
+def create_app(loop):
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, response_factory
+        logger_factory, identity_map_factory, sticky_factory, auth_factory, response_factory
     ])
     init_jinja2(app, filters=dict(datetime=datetime_filter))
     add_routes(app, 'handlers')
     add_static(app)
+    return app
+
+@asyncio.coroutine
+def init(loop):
+    yield from orm.create_pool(loop=loop, **configs.db)
+    yield from Models.check_id_type()
+    yield from search.setup(loop, **configs.search)
+    app = create_app(loop)
     srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', 9000)
     logging.info('server started at http://127.0.0.1:9000...')
     return srv
 
 # 入口，固定写法
 # 获取eventloop然后加入运行事件
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(init(loop))
+    loop.run_forever()
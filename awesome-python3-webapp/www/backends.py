@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+
+'''
+Database backends used by orm: MySQL (aiomysql) and an in-process SQLite engine.
+'''
+
+# orm只通过Backend访问数据库驱动:创建连接池,游标类型,占位符和少量方言上的差异
+# MySQLBackend是原来基于aiomysql的实现;SQLiteBackend基于标准库的sqlite3,
+# 每条连接在一个独立的线程中执行语句,不需要外部服务,用于在笔记本或CI上做压测
+
+import asyncio, os, re, sqlite3, collections
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+class Backend(object):
+
+    name = None
+    # 驱动使用的占位符,orm中的sql统一使用"?"
+    placeholder = '?'
+    DictCursor = None
+    SSDictCursor = None
+
+    @asyncio.coroutine
+    def create_pool(self, loop, kw):
+        raise NotImplementedError()
+
+    # 查询表的近似行数的sql(参数为表名),不支持时为None
+    table_rows_sql = None
+    # 查询表上已有索引的sql(参数为表名),每行为一个索引的一列:_index_, _column_, _unique_,按索引中列的顺序排列
+    index_columns_sql = None
+    # 查询一列的类型的sql(参数为表名和列名),返回_type_,表或列不存在时没有结果
+    column_type_sql = None
+    # 取得select语句执行计划的前缀
+    explain_prefix = 'explain '
+    # 插入时遇到重复键则更新columns的语句后缀
+    def upsert_clause(self, columns):
+        return 'on duplicate key update %s' % ', '.join(['`%s`=values(`%s`)' % (c, c) for c in columns])
+
+    # 插入时遇到重复键则什么也不做的语句后缀
+    # 不使用insert ignore:它会把not null,截断等所有错误都降为警告,错误的数据被静默地修改或丢弃
+    # 主键赋值为自身不会修改记录,影响的行数为0
+    def ignore_clause(self, primary_key):
+        return 'on duplicate key update `%s`=`%s`' % (primary_key, primary_key)
+
+    # 异常为重复键(主键或唯一索引)引起时,返回重复的键的描述,否则返回None
+    def duplicate_key(self, e):
+        return None
+
+    # 终止conn上正在执行的语句,conn仍然可以继续使用
+    @asyncio.coroutine
+    def kill_query(self, conn):
+        raise NotImplementedError()
+
+    # 把schema.sql转换为可以逐条执行的建表语句
+    def schema_statements(self, schema):
+        return [stmt for stmt in _split_sql(schema) if not _RE_DATABASE_STMT.match(stmt)]
+
+_RE_DATABASE_STMT = re.compile(r'^(drop\s+database|create\s+database|use|grant)\b', re.I)
+
+# 按分号拆分sql脚本,去掉注释和空语句
+def _split_sql(script):
+    lines = [line for line in script.splitlines() if not line.strip().startswith('--')]
+    return [stmt.strip() for stmt in '\n'.join(lines).split(';') if stmt.strip()]
+
+class MySQLBackend(Backend):
+
+    name = 'mysql'
+    placeholder = '%s'
+    table_rows_sql = 'select table_rows _num_ from information_schema.tables where table_schema=database() and table_name=?'
+    index_columns_sql = 'select index_name _index_, column_name _column_, 1 - non_unique _unique_ from information_schema.statistics where table_schema=database() and table_name=? order by index_name, seq_in_index'
+    column_type_sql = 'select column_type _type_ from information_schema.columns where table_schema=database() and table_name=? and column_name=?'
+
+    def __init__(self):
+        if aiomysql is None:
+            raise ImportError('aiomysql is required by the mysql backend.')
+        self.DictCursor = aiomysql.DictCursor
+        self.SSDictCursor = aiomysql.SSDictCursor
+
+    _RE_DUPLICATE = re.compile(r"for key '([^']*)'")
+
+    # KILL QUERY只终止语句,不断开连接;conn正在等待结果,因此用同样的参数另建一条连接执行,用完即关闭
+    @asyncio.coroutine
+    def kill_query(self, conn):
+        killer = yield from aiomysql.connect(host=conn.host, port=conn.port, user=conn.user, password=conn._password,
+                                             db=conn.db, loop=conn._loop)
+        try:
+            cur = yield from killer.cursor()
+            yield from cur.execute('KILL QUERY %d' % conn.thread_id())
+            yield from cur.close()
+        finally:
+            killer.close()
+
+    # mysql的错误码1062: Duplicate entry 'xxx' for key 'idx_email'
+    def duplicate_key(self, e):
+        if isinstance(e, aiomysql.IntegrityError) and e.args and e.args[0] == 1062:
+            m = self._RE_DUPLICATE.search(str(e.args[-1]))
+            return m.group(1) if m else ''
+        return None
+
+    # 按配置创建一个aiomysql连接池
+    @asyncio.coroutine
+    def create_pool(self, loop, kw):
+        # 调用一个子协程来创建连接池,creste_pool的返回值是一个pool实例对像
+        return (yield from aiomysql.create_pool(
+            # 前面几项为设置连接的属性
+            host=kw.get('host', 'localhost'),     # 数据库服务器的位置,
+            port=kw.get('port', 3306),            # mysql的端口
+            user=kw['user'],                      # 登录用户名
+            password=kw['password'],              # 密码
+            db=kw['db'],                          # 当前数据库名
+            charset=kw.get('charset', 'utf8'),    # 设置连接使用的编码格式为utf-8
+            autocommit=kw.get('autocommit', True),# 自动提交模式,默认是False
+
+            # 下面几项是可选项
+            maxsize=kw.get('maxsize', 10),  # 最大连接池大小,默认是10
+            minsize=kw.get('minsize', 1),   # 最小连接池大小,默认是10
+            pool_recycle=kw.get('pool_recycle', 3600),  # 连接最长使用的秒数,超过后在取出时关闭并重新连接,-1表示不回收
+            loop=loop    # 设置消息循环
+        ))
+
+
+# 以下是SQLite的实现,接口与aiomysql的连接池,连接和游标保持一致
+
+class SQLiteDictCursor(object):
+    ' cursor returns rows as dict. '
+    dict_rows = True
+
+class SQLiteSSDictCursor(SQLiteDictCursor):
+    ' sqlite reads rows lazily, same as SQLiteDictCursor. '
+    pass
+
+class SQLiteCursor(object):
+
+    def __init__(self, conn, dict_rows):
+        self._conn = conn
+        self._cur = conn._db.cursor()
+        self._dict_rows = dict_rows
+        self._names = None
+        self.rowcount = -1
+        self.description = None
+
+    def _rows(self, rows):
+        if not self._dict_rows or self._names is None:
+            return rows
+        names = self._names
+        return [dict(zip(names, r)) for r in rows]
+
+    @asyncio.coroutine
+    def execute(self, sql, args=()):
+        yield from self._conn._run(self._cur.execute, sql, tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+        self.description = self._cur.description
+        self._names = [d[0] for d in self.description] if self.description else None
+
+    @asyncio.coroutine
+    def fetchall(self):
+        return self._rows((yield from self._conn._run(self._cur.fetchall)))
+
+    @asyncio.coroutine
+    def fetchmany(self, size):
+        return self._rows((yield from self._conn._run(self._cur.fetchmany, size)))
+
+    @asyncio.coroutine
+    def fetchone(self):
+        rs = self._rows((yield from self._conn._run(self._cur.fetchmany, 1)))
+        return rs[0] if rs else None
+
+    @asyncio.coroutine
+    def close(self):
+        yield from self._conn._run(self._cur.close)
+
+class SQLiteConnection(object):
+
+    def __init__(self, path, loop):
+        self._loop = loop
+        # sqlite3的连接只能在创建它的线程中使用,因此每条连接独占一个线程
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._db = None
+        self._path = path
+        self.closed = False
+
+    @asyncio.coroutine
+    def _connect(self):
+        def connect():
+            # isolation_level=None为自动提交模式,事务由begin/commit显式控制
+            db = sqlite3.connect(self._path, isolation_level=None, check_same_thread=False)
+            if self._path != ':memory:':
+                db.execute('pragma journal_mode=wal')
+            db.execute('pragma synchronous=normal')
+            return db
+        self._db = yield from self._run(connect)
+        return self
+
+    def _run(self, fn, *args):
+        return self._loop.run_in_executor(self._executor, fn, *args)
+
+    @asyncio.coroutine
+    def cursor(self, cursor_class=None):
+        return SQLiteCursor(self, cursor_class is not None and getattr(cursor_class, 'dict_rows', False))
+
+    @asyncio.coroutine
+    def begin(self):
+        yield from self._run(self._db.execute, 'begin')
+
+    @asyncio.coroutine
+    def commit(self):
+        yield from self._run(self._db.execute, 'commit')
+
+    @asyncio.coroutine
+    def rollback(self):
+        yield from self._run(self._db.execute, 'rollback')
+
+    def interrupt(self):
+        if self._db is not None:
+            self._db.interrupt()
+
+    @asyncio.coroutine
+    def ping(self, reconnect=True):
+        yield from self._run(self._db.execute, 'select 1')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        db = self._db
+        if db is not None:
+            # 先终止可能还在执行的语句,否则关闭要等它执行完
+            db.interrupt()
+            self._executor.submit(db.close)
+        self._executor.shutdown(wait=False)
+
+class SQLitePool(object):
+
+    def __init__(self, path, minsize, maxsize, loop):
+        self._path = path
+        self._loop = loop
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self._free = collections.deque()
+        self._used = set()
+        self._creating = 0
+        self._waiters = collections.deque()
+        self._closed = False
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used) + self._creating
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    @asyncio.coroutine
+    def _new(self):
+        self._creating = self._creating + 1
+        try:
+            return (yield from SQLiteConnection(self._path, self._loop)._connect())
+        finally:
+            self._creating = self._creating - 1
+
+    @asyncio.coroutine
+    def fill(self):
+        while self.size < self.minsize:
+            self._free.append((yield from self._new()))
+
+    # 有空闲连接时直接取出;没有空闲连接且未达到maxsize时新建;否则等待其他连接被归还
+    @asyncio.coroutine
+    def acquire(self):
+        if self._closed:
+            raise RuntimeError('Cannot acquire connection after closing pool.')
+        while True:
+            while self._free:
+                conn = self._free.popleft()
+                if not conn.closed:
+                    self._used.add(conn)
+                    return conn
+            if self.size < self.maxsize:
+                conn = yield from self._new()
+                self._used.add(conn)
+                return conn
+            waiter = asyncio.Future(loop=self._loop)
+            self._waiters.append(waiter)
+            try:
+                yield from waiter
+            except BaseException:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+
+    def release(self, conn):
+        self._used.discard(conn)
+        if not conn.closed:
+            if self._closed:
+                conn.close()
+            else:
+                self._free.append(conn)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        # 与aiomysql一致,返回一个已完成的future
+        fut = asyncio.Future(loop=self._loop)
+        fut.set_result(None)
+        return fut
+
+    def close(self):
+        self._closed = True
+        while self._free:
+            self._free.popleft().close()
+
+    @asyncio.coroutine
+    def wait_closed(self):
+        for conn in list(self._used):
+            conn.close()
+        self._used.clear()
+
+class SQLiteBackend(Backend):
+
+    name = 'sqlite'
+    placeholder = '?'
+    DictCursor = SQLiteDictCursor
+    SSDictCursor = SQLiteSSDictCursor
+    explain_prefix = 'explain query plan '
+
+    # 不写冲突目标的on conflict do update需要sqlite 3.35以上
+    def upsert_clause(self, columns):
+        return 'on conflict do update set %s' % ', '.join(['`%s`=excluded.`%s`' % (c, c) for c in columns])
+
+    # insert or ignore同样会忽略not null等约束,on conflict do nothing只处理唯一性冲突
+    def ignore_clause(self, primary_key):
+        return 'on conflict do nothing'
+
+    # sqlite3的interrupt()可以在其他线程中调用,正在执行的语句会以OperationalError('interrupted')返回
+    @asyncio.coroutine
+    def kill_query(self, conn):
+        conn.interrupt()
+
+    # 例如: UNIQUE constraint failed: users.email
+    def duplicate_key(self, e):
+        if isinstance(e, sqlite3.IntegrityError) and str(e).startswith('UNIQUE constraint failed'):
+            return str(e).split(':', 1)[-1].strip()
+        return None
+    index_columns_sql = 'select il.name _index_, ii.name _column_, il."unique" _unique_ from pragma_index_list(?) il, pragma_index_info(il.name) ii order by il.name, ii.seqno'
+    column_type_sql = 'select type _type_ from pragma_table_info(?) where name=?'
+
+    # db为数据库文件的路径;为':memory:'时每条连接都是独立的内存数据库,因此连接池只保留一条连接
+    @asyncio.coroutine
+    def create_pool(self, loop, kw):
+        path = kw.get('db', ':memory:')
+        maxsize = kw.get('maxsize', 10)
+        minsize = kw.get('minsize', 1)
+        if path == ':memory:':
+            maxsize = minsize = 1
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        pool = SQLitePool(path, min(minsize, maxsize), maxsize, loop)
+        yield from pool.fill()
+        return pool
+
+    _RE_ENGINE = re.compile(r'\)\s*engine\s*=.*$', re.I | re.S)
+    _RE_KEY = re.compile(r'^\s*(unique\s+)?key\s+`(\w+)`\s*\(([^)]*)\)\s*,?\s*$', re.I)
+    _RE_INDEX = re.compile(r'^create\s+(unique\s+)?index\s+`(\w+)`\s+on\s+`(\w+)`\s*\(([^)]*)\)\s*$', re.I)
+
+    # schema.sql是为mysql写的:去掉建库,授权和engine等语句,把表内的key改为单独的create index
+    # sqlite中索引名在整个数据库内必须唯一,因此在索引名前加上表名
+    def schema_statements(self, schema):
+        statements = []
+        for stmt in super(SQLiteBackend, self).schema_statements(schema):
+            k = self._RE_INDEX.match(stmt)
+            if k is not None:
+                statements.append('create %sindex `%s_%s` on `%s` (%s)' % ('unique ' if k.group(1) else '', k.group(3), k.group(2), k.group(3), k.group(4)))
+                continue
+            m = re.match(r'^create\s+table\s+`?(\w+)`?\s*\(', stmt, re.I)
+            if m is None:
+                statements.append(stmt)
+                continue
+            table = m.group(1)
+            stmt = self._RE_ENGINE.sub(')', stmt)
+            lines = []
+            indexes = []
+            for line in stmt.splitlines():
+                k = self._RE_KEY.match(line)
+                if k is None:
+                    lines.append(line)
+                    continue
+                indexes.append('create %sindex `%s_%s` on `%s` (%s)' % ('unique ' if k.group(1) else '', table, k.group(2), table, k.group(3)))
+            # 去掉key被移除后,最后一列定义末尾多余的逗号
+            body = '\n'.join(lines)
+            body = re.sub(r',(\s*\)\s*)$', r'\1', body)
+            statements.append(body)
+            statements.extend(indexes)
+        return statements
+
+_backends = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+
+# 按名称创建backend,configs.db中的backend,默认为mysql
+def get_backend(name='mysql'):
+    try:
+        return _backends[name]()
+    except KeyError:
+        raise ValueError('Unknown database backend: %s' % name)
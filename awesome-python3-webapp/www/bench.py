@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+'''
+End-to-end throughput benchmark of handlers on the in-process SQLite backend.
+
+    python3 bench.py -n 2000 -c 20 /api/blogs /api/blogs?page=3
+    python3 bench.py --log sync; python3 bench.py --log queue
+'''
+
+# 不需要mysql:用sqlite建立schema.sql中的表,写入测试数据,在随机端口上启动应用,
+# 然后用多个并发的客户端请求各个地址,输出每个地址的吞吐量和延迟
+
+import argparse, asyncio, os, random, tempfile, time
+
+import aiohttp
+
+import logs
+import orm
+from app import create_app
+from config import configs
+from Models import User, Blog
+
+# 默认压测的地址,{blog_id}会被替换为随机的一篇日志
+DEFAULT_PATHS = ['/api/blogs', '/api/blogs?page=3', '/api/blogs/{blog_id}', '/metrics']
+
+@asyncio.coroutine
+def seed(blogs):
+    user = User(email='bench@example.com', passwd='0' * 40, admin=False, name='bench', image='about:blank')
+    yield from user.save()
+    now = time.time()
+    objs = [Blog(user_id=user.id, user_name=user.name, user_image=user.image, name='Blog %d' % i,
+                 summary='Summary of blog %d' % i, content='Content of blog %d. ' % i * 50, created_at=now - i)
+            for i in range(blogs)]
+    yield from Blog.save_many(objs, batch_size=200)
+    return [b.id for b in objs]
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+@asyncio.coroutine
+def run_path(session, base, path, blog_ids, requests, concurrency):
+    latencies = []
+    errors = [0]
+    remaining = [requests]
+
+    @asyncio.coroutine
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] = remaining[0] - 1
+            url = base + path.replace('{blog_id}', str(random.choice(blog_ids)))
+            start = time.time()
+            resp = yield from session.get(url)
+            try:
+                yield from resp.read()
+                if resp.status != 200:
+                    errors[0] = errors[0] + 1
+            finally:
+                resp.release()
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    yield from asyncio.gather(*[worker() for i in range(concurrency)])
+    elapsed = time.time() - start
+    print('%-28s %8.1f req/s  p50 %6.2f ms  p99 %6.2f ms  errors %d' % (
+        path, len(latencies) / elapsed, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, errors[0]))
+
+@asyncio.coroutine
+def main(loop, args):
+    db = args.db or os.path.join(tempfile.mkdtemp(prefix='awesome-bench-'), 'awesome.db')
+    yield from orm.create_pool(loop=loop, backend='sqlite', db=db, maxsize=args.pool, minsize=args.pool, warmup=args.pool)
+    yield from orm.create_schema()
+    blog_ids = yield from seed(args.blogs)
+    print('sqlite database %s with %d blogs' % (db, len(blog_ids)))
+
+    app = create_app(loop)
+    handler = app.make_handler()
+    srv = yield from loop.create_server(handler, '127.0.0.1', 0)
+    base = 'http://127.0.0.1:%d' % srv.sockets[0].getsockname()[1]
+    session = aiohttp.ClientSession(loop=loop, connector=aiohttp.TCPConnector(limit=args.concurrency, loop=loop))
+    try:
+        for path in args.paths or DEFAULT_PATHS:
+            yield from run_path(session, base, path, blog_ids, args.requests, args.concurrency)
+    finally:
+        session.close()
+        srv.close()
+        yield from srv.wait_closed()
+        yield from orm.close_pool()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark handlers on the SQLite backend.')
+    parser.add_argument('paths', nargs='*', help='paths to request, {blog_id} is replaced by a random blog id')
+    parser.add_argument('-n', '--requests', type=int, default=2000, help='requests per path')
+    parser.add_argument('-c', '--concurrency', type=int, default=20, help='concurrent clients')
+    parser.add_argument('--blogs', type=int, default=1000, help='number of blogs to create')
+    parser.add_argument('--pool', type=int, default=5, help='database connections')
+    parser.add_argument('--db', default=None, help='sqlite database file, a temporary file by default')
+    parser.add_argument('--log', choices=['off', 'sync', 'queue'], default='off',
+                        help='off: warnings only; sync: every category at INFO written on the event loop; queue: configs.logging')
+    parser.add_argument('--log-file', default=None, help='log file, a temporary file by default')
+    args = parser.parse_args()
+    # 比较日志的开销:sync相当于之前每个请求在事件循环中同步写出多行INFO日志,queue为configs.logging的配置
+    log_file = args.log_file or os.path.join(tempfile.mkdtemp(prefix='awesome-bench-'), 'bench.log')
+    if args.log == 'off':
+        logs.setup(dict(level='WARNING', file=log_file))
+    elif args.log == 'sync':
+        logs.setup(dict(level='INFO', levels=dict((k, 'INFO') for k in configs.logging.levels), file=log_file, queue=False))
+    else:
+        config = dict(configs.logging)
+        config['file'] = log_file
+        logs.setup(config)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, args))
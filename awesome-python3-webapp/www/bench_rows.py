@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of building Model objects from large result sets on the in-process SQLite backend.
+
+    python3 bench_rows.py --rows 10000
+'''
+
+# 比较三种方式处理同一个10000行的结果:
+#   dict: DictCursor返回dict,再对每一行调用cls(**row)(之前findAll的做法)
+#   tuple: 普通游标返回元组,按__columns__的顺序直接给各个槽赋值(现在findAll的做法)
+#   raw: findAll(raw=True),只返回dict,不构造对象
+# 分别给出只构造对象的耗时和包括查询的总耗时
+
+import argparse, asyncio, logging, os, tempfile, time
+
+import orm
+from Models import Blog
+
+@asyncio.coroutine
+def seed(rows):
+    now = time.time()
+    objs = [Blog(user_id=i % 100 + 1, user_name='bench', user_image='about:blank', name='Blog %d' % i,
+                 summary='Summary of blog %d' % i, content='Content of blog %d.' % i, created_at=now - i)
+            for i in range(rows)]
+    yield from Blog.save_many(objs, batch_size=500)
+
+def best(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+@asyncio.coroutine
+def best_async(fn, repeat):
+    times = []
+    for i in range(repeat):
+        # 每次都让结果缓存失效,测量的是真正的查询
+        orm.invalidate(Blog.__table__)
+        start = time.perf_counter()
+        yield from fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+@asyncio.coroutine
+def main(loop, args):
+    db = os.path.join(tempfile.mkdtemp(prefix='awesome-bench-'), 'rows.db')
+    yield from orm.create_pool(loop=loop, backend='sqlite', db=db, ping_interval=0)
+    yield from orm.create_schema()
+    yield from seed(args.rows)
+
+    dict_rows = yield from orm.select(Blog.__select__, [])
+    tuple_rows = yield from orm.select(Blog.__select__, [], tuples=True)
+    print('%d rows, best of %d' % (len(dict_rows), args.repeat))
+    print('hydration only:')
+    print('  dict  cls(**row)     %8.2f ms' % (best(lambda: [Blog._load(r) for r in dict_rows], args.repeat) * 1000))
+    print('  tuple _loadTuples    %8.2f ms' % (best(lambda: Blog._loadTuples(tuple_rows, Blog.__columns__), args.repeat) * 1000))
+
+    @asyncio.coroutine
+    def by_dict():
+        rs = yield from orm.select(Blog.__select__, [], None, Blog.__table__, Blog.__cache__)
+        return [Blog._load(r) for r in rs]
+
+    print('query and hydration:')
+    print('  dict  (before)       %8.2f ms' % ((yield from best_async(by_dict, args.repeat)) * 1000))
+    print('  findAll()            %8.2f ms' % ((yield from best_async(lambda: Blog.findAll(), args.repeat)) * 1000))
+    print('  findAll(raw=True)    %8.2f ms' % ((yield from best_async(lambda: Blog.findAll(raw=True), args.repeat)) * 1000))
+    yield from orm.close_pool()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark row hydration.')
+    parser.add_argument('--rows', type=int, default=10000, help='rows in the result set')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each case, the best is reported')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, args))
@@ -10,11 +10,67 @@
 configs = {
     'debug': True,
     'db': {
+        # 数据库驱动:mysql(aiomysql)或sqlite(db为数据库文件的路径)
+        'backend': 'mysql',
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www',
         'password': 'www',
-        'db': 'awesome'
+        'db': 'awesome',
+        # 只读副本,例如[{'host': '10.0.0.2'}, {'host': '10.0.0.3'}],未写出的配置与主库相同
+        'replicas': [],
+        # 请求内发生写操作后,该请求的读操作也走主库
+        'sticky': True,
+        # 写入后同一会话(浏览器)在多少秒内的请求也读主库,应大于副本的复制延迟
+        'sticky_window': 5,
+        # 启动时预先建立的连接数
+        'warmup': 5,
+        # 每隔多少秒ping空闲连接并调整预建立的连接数,0表示不做
+        'ping_interval': 60,
+        # 连接使用超过多少秒后重新连接
+        'pool_recycle': 3600,
+        # 耗时超过多少秒的语句记入慢查询日志(select同时取得执行计划),None表示不记录
+        'slow_query_threshold': 0.1,
+        # 每条语句默认的期限(秒),超过时终止语句并抛出orm.QueryTimeoutError,None表示不限制
+        'query_timeout': 10
+    },
+    'logging': {
+        # 根logger的级别
+        'level': 'INFO',
+        # 各类别的级别:request(每个请求一行),auth(检查cookie),response,handler(处理函数和参数),sql(每条语句)
+        # 开发时可以在config_override.py中把它们改为INFO
+        'levels': {
+            'request': 'INFO',
+            'auth': 'WARNING',
+            'response': 'WARNING',
+            'handler': 'WARNING',
+            'sql': 'WARNING'
+        },
+        # 各类别的采样率,1表示全部记录
+        'sample': {
+            'request': 1.0,
+            'sql': 1.0
+        },
+        # 日志文件,None表示输出到stderr
+        'file': None,
+        # 在后台线程中写日志,队列满时丢弃
+        'queue': True,
+        'queue_size': 10000
+    },
+    'ids': {
+        # 主键的类型:string为varchar(50)的字符串主键,与schema.sql和已有的数据库一致
+        # 新建的数据库可以在config_override.py中设置为'bigint'(64位按时间递增的整数,见ids.py),并用schema.py生成的语句建表
+        # 启动时检查users.id列的类型,与这里不一致时拒绝启动
+        'type': 'string',
+        # 生成id的进程编号0~1023,多个进程或多台机器同时写入时各自使用不同的编号,None表示按进程号取(只适合单进程)
+        # 多进程部署时为每个进程设置环境变量AWESOME_WORKER_ID,它优先于这里的配置,见ids.py
+        'worker_id': None
+    },
+    'search': {
+        # 全文索引的文件,启动时载入,None表示不保存,每次启动都遍历blogs表重新建立
+        'file': 'search.idx',
+        # 有修改时每隔多少秒写回文件
+        'save_interval': 300
     },
     'session': {
         'secret':'Awesome'
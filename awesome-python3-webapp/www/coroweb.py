@@ -9,6 +9,10 @@ from aiohttp import web
 
 from apis import APIError
 
+import logs
+
+_handler_log = logs.getLogger('handler')
+
 # get 和 post 为修饰方法,主要是为对象加上'__method__' 和'__route__'属性
 # 为了把我们定义的url实际处理方法,以get请求或post请求的区分
 def get(path):
@@ -167,7 +171,8 @@ class RequestHandler(object):
             for name in self._required_kw_args:
                 if not name in kw:
                     return web.HTTPBadRequest('Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+        # kw在写出日志时才格式化
+        _handler_log.info('call', handler=self._func.__name__, args=kw)
         try:
             # 对url进行处理
             r = yield from self._func(**kw)
@@ -3,13 +3,17 @@
 import re, time, json, logging, hashlib, base64, asyncio
 
 import markdown2
+import metrics
+import orm
+import search
 
 from aiohttp import web
 
 from coroweb import get, post
-from apis import Page, APIError, APIValueError, APIResourceNotFoundError
+from apis import Page, CursorPage, APIError, json_default, APIValueError, APIResourceNotFoundError, APIPermissionError
 
-from models import User, Comment, Blog, next_id
+from orm import DuplicateKeyError
+from Models import User, Comment, Blog, next_id
 from config import configs
 
 COOKIE_NAME = 'awesession'
@@ -36,7 +40,7 @@ def user2cookie(user, max_age):
     # build cookie string by:id-expires-sha1
     expires = str(int(time.time() + max_age))
     s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)
-    L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
+    L = [str(user.id), expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
     return '-'.join(L)
 
 # 第11天添加的text2html(text)
@@ -66,7 +70,7 @@ def cookie2user(cookie_str):
         if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():
             logging.info('Invalid sha1')
             return None
-        user.passwd = '******'
+        # user在标识映射中与同一请求的其他查询共享,不能修改passwd,输出json时由User.__hidden__隐藏
         return user
     except Exception as e:
         logging.exception(e)
@@ -129,7 +133,7 @@ def authenticate(*, email, passwd):
     user = users[0]
     # check passwd:
     sha1 = hashlib.sha1()
-    sha1.update(user.id.encode('utf-8'))
+    sha1.update(str(user.id).encode('utf-8'))
     sha1.update(b':')
     sha1.update(passwd.encode('utf-8'))
     if user.passwd != sha1.hexdigest():
@@ -137,9 +141,8 @@ def authenticate(*, email, passwd):
     # authenticate ok, set cookie:
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
-    user.passwd = '******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = json.dumps(user, ensure_ascii=False, default=json_default).encode('utf-8')
     return r
 
 # 退出登录
@@ -180,35 +183,77 @@ def api_register_user(*, email, name, passwd):
         raise APIValueError('email')
     if not passwd or not _RE_SHA1.match(passwd):
         raise APIValueError('passwd')
-    users = yield from User.findAll('email=?', [email])
-    if len(users) > 0:
-        raise APIError('register:failed', 'email', 'Email is already in use.')
     uid = next_id()
     sha1_passwd = '%s:%s' % (uid, passwd)
     # 用户口令经过SHA1计算后的40为Hsah字符串.
     user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(),
                 image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
-    yield from user.save()
+    # email上有唯一索引,直接插入,重复时由数据库报错,不需要先查询,也不会有并发注册的竞争
+    try:
+        yield from user.save()
+    except DuplicateKeyError as e:
+        # 只有email的唯一索引重复才是邮箱已注册;MySQL报告索引名(idx_email或users.idx_email),SQLite报告列名(users.email)
+        if e.key.split('.')[-1] not in ('idx_email', 'email'):
+            raise
+        raise APIError('register:failed', 'email', 'Email is already in use.')
     # make session cookie
     r = web.Response()
     r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
-    user.passwd = '*******'
     r.content_type = 'application/json'
-    r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
+    r.body = json.dumps(user, ensure_ascii=False, default=json_default).encode('utf-8')
     return r
 
 
 # 第12天实现的查看博客
+# 传入cursor参数(第一页传空字符串)时改用基于游标的键集分页,翻到多深的页代价都相同
 @get('/api/blogs')
-def api_blogs(*, page='1'):
+def api_blogs(*, page='1', cursor=None):
+    if cursor is not None:
+        p = CursorPage(cursor)
+        blogs = yield from Blog.findAll(orderBy='created_at desc, id desc', limit=p.limit, after=p.after, before=p.before, defer=['content'])
+        return dict(page=p, blogs=p.paginate(blogs))
     page_index =  get_page_index(page)
-    num = yield from Blog.findNumber('count(id)')
+    num = yield from Blog.countAll()
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    # 列表中不需要显示content,不查询它
+    blogs = yield from Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), defer=['content'])
+    return dict(page=p, blogs=blogs)
+
+
+# 全文搜索日志,按BM25得分排序,每篇日志带有score;列表中不需要显示content,不查询它
+@get('/api/search')
+def api_search(*, q='', page='1'):
+    if not q or not q.strip():
+        raise APIValueError('q', 'query cannot be empty.')
+    page_index = get_page_index(page)
+    num, hits = search.query(q, (page_index - 1) * 10, 10)
+    p = Page(num, page_index)
+    if not hits:
+        return dict(page=p, blogs=())
+    rs = yield from Blog.findAll('`id` in (%s)' % orm.create_args_string(len(hits)), [k for k, score in hits], defer=['content'])
+    found = dict([(b.id, b) for b in rs])
+    blogs = []
+    for k, score in hits:
+        blog = found.get(k, None)
+        if blog is not None:
+            blog.score = score
+            blogs.append(blog)
     return dict(page=p, blogs=blogs)
 
+# 以Prometheus的文本格式输出监控指标(连接池,查询耗时等)
+@get('/metrics')
+def api_metrics():
+    r = web.Response(body=metrics.render().encode('utf-8'))
+    r.content_type = metrics.CONTENT_TYPE
+    return r
+
+# 最近的慢查询(最近的在前),select带有EXPLAIN得到的执行计划
+@get('/api/slow_queries')
+def api_slow_queries(request):
+    check_admin(request)
+    return dict(queries=orm.slow_queries())
 
 # 第11天代码
 @get('/api/blogs/{id}')
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+'''
+Compact, time-ordered 64-bit IDs (snowflake style).
+'''
+
+# 一个id由三部分组成(最高位为0,id总是正数,可以存入有符号的bigint):
+#   41位: 自EPOCH起的毫秒数,可以使用约69年,id按时间递增,新记录总是插入到主键索引的末尾
+#   10位: 进程(worker)的编号0~1023,多个进程同时生成id时各自使用不同的编号,id就不会重复
+#   12位: 同一毫秒内的序号,每个进程每毫秒最多4096个id
+# 与之前50个字符的字符串id相比,主键和引用它的列(blog_id, user_id)以及所有二级索引中的每一项都只占8个字节
+
+import logging, os, threading, time
+
+EPOCH = 1451606400000   # 2016-01-01 00:00:00 UTC,毫秒
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+def _now():
+    return int(time.time() * 1000)
+
+class IdGenerator(object):
+
+    def __init__(self, worker_id):
+        if worker_id < 0 or worker_id > MAX_WORKER:
+            raise ValueError('Invalid worker id: %s' % worker_id)
+        self.worker_id = worker_id
+        self._last = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now = _now()
+            if now < self._last:
+                # 系统时间被调回时继续使用上一次的时间,保证id递增
+                now = self._last
+            if now == self._last:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 这一毫秒的序号用完了,直接使用下一毫秒,不在事件循环中等待,时钟追上来之后恢复正常
+                    now = self._last + 1
+            else:
+                self._sequence = 0
+            self._last = now
+            return ((now - EPOCH) << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+# 进程的编号依次取自:
+#   环境变量AWESOME_WORKER_ID,进程管理器可以为每个进程设置不同的值(例如supervisor的%(process_num)d)
+#   configure(worker_id),即configs.ids.worker_id
+#   进程号的低10位,进程号模1024相同的两个进程会生成重复的id,只适合单进程
+# 编号在每个进程第一次生成id时才确定:导入之后fork出的子进程(预加载,multiprocessing)会重新选择,
+# 不会沿用父进程的编号;子进程使用configs中配置的同一个编号或进程号时记录警告,这时应改用环境变量
+# 单独启动的多个进程无法检测,configure的warn为True(非debug部署)时,使用进程号也记录警告
+WORKER_ENV = 'AWESOME_WORKER_ID'
+
+_import_pid = os.getpid()
+_worker_id = None
+_warn = False
+_generator = None
+_pid = None
+
+def configure(worker_id=None, warn=False):
+    global _worker_id, _warn, _generator
+    _worker_id = worker_id
+    _warn = warn
+    _generator = None
+
+def _create():
+    global _generator, _pid
+    pid = os.getpid()
+    forked = pid != _import_pid
+    env = os.environ.get(WORKER_ENV, None)
+    if env:
+        worker_id = int(env)
+    elif _worker_id is not None:
+        worker_id = _worker_id
+        if forked:
+            logging.warning('worker id %s is shared by forked processes and may produce duplicate ids, set %s for each process.' % (worker_id, WORKER_ENV))
+    else:
+        worker_id = pid & MAX_WORKER
+        if forked or _warn:
+            logging.warning('no worker id configured, using %s from the pid; processes whose pids are equal mod %s produce duplicate ids, set %s for each process.' % (worker_id, MAX_WORKER + 1, WORKER_ENV))
+    _generator = IdGenerator(worker_id)
+    _pid = pid
+
+def next_id():
+    if _generator is None or _pid != os.getpid():
+        _create()
+    return _generator.next_id()
+
+# 返回id生成时的时间戳(秒)
+def id_time(id):
+    return ((int(id) >> (WORKER_BITS + SEQUENCE_BITS)) + EPOCH) / 1000.0
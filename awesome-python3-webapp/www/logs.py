@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+'''
+Structured logging by category, with lazy formatting, sampling and a queue-based handler.
+'''
+
+# 每个类别(request, sql等)对应一个名为'awesome.<类别>'的logger,可以单独设置级别和采样率
+# 日志写成"事件 key=value ..."的形式,字段保存在LogRecord中,直到写出时才格式化
+# 使用队列时,事件循环中只判断级别,采样并把LogRecord放入队列,格式化和写文件都由后台线程(QueueListener)完成
+
+import atexit, logging, logging.handlers, queue, random
+
+# 按类别缓存的Logger
+_loggers = dict()
+
+class Logger(object):
+
+    def __init__(self, category):
+        self.category = category
+        # 采样率,小于1时只记录这个比例的日志,记录的日志带有sample字段
+        self.sample = 1.0
+        self._logger = logging.getLogger('awesome.%s' % category)
+
+    def isEnabledFor(self, level):
+        return self._logger.isEnabledFor(level)
+
+    def log(self, level, event, fields):
+        logger = self._logger
+        if not logger.isEnabledFor(level):
+            return
+        if self.sample < 1.0:
+            if random.random() >= self.sample:
+                return
+            fields['sample'] = self.sample
+        # 直接构造LogRecord,不经过Logger._log,省去findCaller对调用栈的查找
+        record = logger.makeRecord(logger.name, level, '(unknown file)', 0, event, (), None, extra=dict(fields=fields))
+        logger.handle(record)
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, fields)
+
+# 返回某个类别的Logger,例如getLogger('sql')
+def getLogger(category):
+    logger = _loggers.get(category, None)
+    if logger is None:
+        logger = _loggers[category] = Logger(category)
+    return logger
+
+def _format_value(v):
+    if isinstance(v, float):
+        v = '%.6g' % v
+    else:
+        v = str(v)
+    if not v or ' ' in v or '"' in v or '=' in v or '\n' in v:
+        return '"%s"' % v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return v
+
+# 在消息后面追加key=value形式的字段
+class StructFormatter(logging.Formatter):
+
+    def formatMessage(self, record):
+        fields = getattr(record, 'fields', None)
+        if fields:
+            record.message = '%s %s' % (record.message, ' '.join(['%s=%s' % (k, _format_value(v)) for k, v in fields.items()]))
+        return super(StructFormatter, self).formatMessage(record)
+
+class QueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, queue):
+        super(QueueHandler, self).__init__(queue)
+        self.dropped = 0
+
+    # 默认的prepare会在调用者的线程中格式化消息,这里原样放入队列,由后台线程格式化
+    def prepare(self, record):
+        return record
+
+    # 队列满时丢弃日志,不阻塞事件循环
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped = self.dropped + 1
+
+_listener = None
+
+# 按configs.logging配置日志,替换根logger原有的handler:
+#   level: 根logger的级别
+#   levels: 各类别的级别,例如{'sql': 'WARNING'}
+#   sample: 各类别的采样率,例如{'request': 0.1}
+#   file: 日志文件,为None时写到stderr
+#   queue: 为True时通过队列在后台线程中写日志,queue_size为队列的长度
+def setup(config=None):
+    global _listener
+    config = config or dict()
+    stop()
+    root = logging.getLogger()
+    root.setLevel(config.get('level', 'INFO'))
+    for category, level in (config.get('levels', None) or dict()).items():
+        logging.getLogger('awesome.%s' % category).setLevel(level)
+    for category, sample in (config.get('sample', None) or dict()).items():
+        getLogger(category).sample = sample
+    if config.get('file', None):
+        handler = logging.FileHandler(config['file'], encoding='utf-8')
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(StructFormatter(config.get('format', '%(levelname)s:%(name)s:%(message)s')))
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    if config.get('queue', True):
+        root.addHandler(QueueHandler(queue.Queue(config.get('queue_size', 10000))))
+        _listener = logging.handlers.QueueListener(root.handlers[0].queue, handler, respect_handler_level=True)
+        _listener.start()
+    else:
+        root.addHandler(handler)
+
+# 停止后台线程,队列中剩余的日志会先写完
+def stop():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(stop)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+'''
+Simple metrics (counter, gauge, histogram) exposed in Prometheus text format.
+'''
+
+import threading
+
+# 所有已注册的指标,render()按注册顺序输出
+_registry = []
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+def _format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+# 指标的基类,name为指标名,labelnames为标签名的元组
+# 指标可以在多个线程中更新(例如日志线程),因此修改时加锁
+class Metric(object):
+
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _check(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError('Incorrect label count for %s: %s' % (self.name, labelvalues))
+        return tuple(labelvalues)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, k, v) for k, v in sorted(self._values.items())]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        for name, labelvalues, value in self.samples():
+            lines.append('%s%s %s' % (name, _format_labels(self.labelnames, labelvalues), _format_value(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._check(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    # callback为一个无参函数,返回[(标签值的元组, 值), ...],用于在输出时读取当前的状态(例如连接池的大小)
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self._callback = callback
+
+    def set(self, value, *labelvalues):
+        key = self._check(labelvalues)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._check(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def samples(self):
+        if self._callback is None:
+            return super(Gauge, self).samples()
+        return [(self.name, self._check(k), v) for k, v in self._callback()]
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    # 每组标签对应[各个桶的计数, 总和, 总数],桶的计数不是累计的,输出时再累加
+    def observe(self, value, *labelvalues):
+        key = self._check(labelvalues)
+        with self._lock:
+            item = self._values.get(key, None)
+            if item is None:
+                item = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    item[0][i] = item[0][i] + 1
+                    break
+            item[1] = item[1] + value
+            item[2] = item[2] + 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        with self._lock:
+            items = sorted((k, ([c for c in v[0]], v[1], v[2])) for k, v in self._values.items())
+        for labelvalues, (counts, total, count) in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative = cumulative + c
+                lines.append('%s_bucket%s %s' % (self.name, _format_labels(self.labelnames, labelvalues, ('le', _format_value(bound))), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(self.labelnames, labelvalues), _format_value(total)))
+            lines.append('%s_count%s %s' % (self.name, _format_labels(self.labelnames, labelvalues), count))
+        return '\n'.join(lines)
+
+# 按Prometheus的文本格式输出所有指标
+def render():
+    return '\n'.join(m.render() for m in _registry) + '\n'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
@@ -2,77 +2,1270 @@
 
 # 时间:2016年04月24日05:00:00
 
-import asyncio, logging
+import asyncio, logging, weakref, time, re, os, collections
+from collections import OrderedDict
 
-import aiomysql
+import backends
+import logs
+import metrics
+
+_sql_log = logs.getLogger('sql')
 
 def log(sql, args=()):
-    logging.info('SQL: %s' % sql)
+    _sql_log.info('sql', sql=sql)
+
+# 已编译SQL语句的缓存
+# 同一条sql会被反复执行(例如/api/blogs和/blog/{id}),每次都拼接字符串并把"?"替换为"%s"是一种浪费
+# 因此把最终交给驱动执行的sql缓存起来,并统计命中/未命中的次数
+class StatementCache(object):
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        # 数据库驱动使用的占位符,由create_pool按backend设置
+        self.placeholder = '%s'
+        self.hits = 0
+        self.misses = 0
+        self._statements = dict()
+
+    # key可以是sql字符串本身,也可以是(模型, where, orderBy, limit形态)这样的元组
+    # build是一个无参函数,仅在缓存未命中时调用,用于构造sql
+    def get(self, key, build):
+        try:
+            sql = self._statements[key]
+        except KeyError:
+            self.misses = self.misses + 1
+            sql = build()
+            # where子句可能是动态拼接的,为避免缓存无限增长,满了之后直接清空
+            if len(self._statements) >= self.maxsize:
+                self._statements.clear()
+            self._statements[key] = sql
+            return sql
+        self.hits = self.hits + 1
+        return sql
+
+    # sql语句的占位符为"?",mysql的占位符为"%s",替换后的结果同样缓存起来
+    def prepare(self, sql):
+        if self.placeholder == '?':
+            return sql
+        return self.get(sql, lambda: sql.replace('?', self.placeholder))
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._statements))
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self._statements.clear()
+
+_statements = StatementCache()
+
+# 返回语句缓存的命中/未命中统计
+def statement_stats():
+    return _statements.stats()
+
+# 主库的连接池,由create_pool创建
+__pool = None
+# 只读副本(replica)的连接池列表,为空时读写都使用主库的连接池
+__replicas = []
+_pool_names = weakref.WeakKeyDictionary()
+_acquire_timeout = None
+_query_timeout = None
+# 发生过写操作的Task,之后该Task内的读操作也走主库,保证能读到自己刚写入的数据
+_sticky_tasks = weakref.WeakSet()
+# 写入过数据的Task,用于把读主库延续到同一会话的后续请求,见written
+_written_tasks = weakref.WeakSet()
+_sticky = True
+_sticky_window = 5
+_next_replica = 0
+
+# 数据库backend,由create_pool按configs.db中的backend创建,见backends.py
+_backend = None
+
+# 按配置创建一个连接池
+@asyncio.coroutine
+def _create_pool(loop, kw):
+    return (yield from _backend.create_pool(loop, kw))
+
+# 连接池的维护:启动时预先建立连接(warm-up),定期ping空闲的连接,并根据等待连接的时间调整预建立的连接数
+#   warmup: 启动时预先建立的连接数,默认等于minsize,避免部署后的第一波请求在请求路径上做TCP和认证握手
+#   ping_interval: 维护的间隔(秒),默认60,为0时不做定期维护
+#   slow_wait: 等待连接超过这个时间(秒)视为慢,默认0.005;出现慢等待时增加预建立的连接数,
+#              连续空闲时逐渐减少,但不少于warmup
+# 连接的最长使用时间由pool_recycle控制,过期的连接在取出时由aiomysql关闭并重新连接(仅mysql)
+class PoolKeeper(object):
+
+    def __init__(self, pool, name, kw):
+        self.pool = pool
+        self.name = name
+        self.warmup = max(kw.get('warmup', kw.get('minsize', 1)), 0)
+        self.ping_interval = kw.get('ping_interval', 60)
+        self.slow_wait = kw.get('slow_wait', 0.005)
+        self.target = self.warmup
+        self._slow = 0
+        self._idle = 0
+        self._task = None
+
+    # 由_checkout调用,记录一次等待连接的时间
+    def observe(self, wait):
+        if wait > self.slow_wait:
+            self._slow = self._slow + 1
+
+    # 建立连接直到连接池中至少有n条连接(不超过maxsize)
+    # 连接池只在没有空闲连接时才新建连接,因此需要先把连接都取出来,最后再一起归还
+    @asyncio.coroutine
+    def fill(self, n):
+        pool = self.pool
+        n = min(n, pool.maxsize)
+        held = []
+        try:
+            while pool.size < n and (pool.freesize > 0 or pool.size < pool.maxsize):
+                held.append((yield from pool.acquire()))
+        finally:
+            for conn in held:
+                pool.release(conn)
+
+    # 关闭多余的空闲连接,使连接池中的连接数减少到n(不少于minsize)
+    @asyncio.coroutine
+    def shrink(self, n):
+        pool = self.pool
+        for i in range(min(pool.freesize, pool.size - max(n, pool.minsize))):
+            conn = yield from pool.acquire()
+            conn.close()
+            pool.release(conn)
+
+    # 依次ping每条空闲的连接,已断开的连接会被重新连接,失败的连接被关闭并从连接池中移除
+    @asyncio.coroutine
+    def ping(self):
+        pool = self.pool
+        for i in range(pool.freesize):
+            conn = yield from pool.acquire()
+            try:
+                yield from conn.ping()
+            except Exception as e:
+                logging.warning('ping connection of pool %s failed: %s' % (self.name, e))
+                conn.close()
+            finally:
+                pool.release(conn)
+
+    # 根据上一个间隔内的慢等待次数调整预建立的连接数
+    @asyncio.coroutine
+    def adjust(self):
+        pool = self.pool
+        if self._slow > 0:
+            self._idle = 0
+            self.target = min(pool.maxsize, max(self.target, pool.size) + max(1, pool.maxsize // 5))
+        else:
+            self._idle = self._idle + 1
+            if self._idle >= 5:
+                self.target = max(self.warmup, self.target - 1)
+        self._slow = 0
+        if pool.size < self.target:
+            yield from self.fill(self.target)
+        elif pool.size > self.target:
+            yield from self.shrink(self.target)
+
+    @asyncio.coroutine
+    def run(self):
+        while True:
+            yield from asyncio.sleep(self.ping_interval)
+            try:
+                yield from self.ping()
+                yield from self.adjust()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception(e)
+
+    def start(self, loop):
+        if self.ping_interval and self._task is None:
+            self._task = asyncio.ensure_future(self.run(), loop=loop)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+# 连接池名称 -> PoolKeeper
+_keepers = dict()
+
+# 创建连接池并预先建立连接,启动定期维护
+@asyncio.coroutine
+def _open_pool(loop, name, kw):
+    pool = yield from _create_pool(loop, kw)
+    _pool_names[pool] = name
+    keeper = PoolKeeper(pool, name, kw)
+    if keeper.warmup > pool.size:
+        logging.info('warm up connection pool %s: %s connections' % (name, keeper.warmup))
+        yield from keeper.fill(keeper.warmup)
+    keeper.start(loop)
+    _keepers[name] = keeper
+    return pool
+
+# 查询结果缓存:按(sql, args, size)缓存select返回的行,带有过期时间(ttl),超过maxsize条时淘汰最久未使用的
+# 每张表有一个版本号,作为缓存键的一部分;Model的save/update/remove修改某张表时把版本号加1,
+# 这张表之前缓存的结果就再也不会被命中,之后由LRU淘汰
+# 只有设置了__cache__的Model的查询会被缓存,直接调用execute()修改表时需要自己调用invalidate(table)
+class ResultCache(object):
+
+    # maxrows:行数超过它的结果不缓存,避免个别大结果占用过多内存
+    def __init__(self, maxsize=1024, maxrows=1000):
+        self.maxsize = maxsize
+        self.maxrows = maxrows
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._versions = dict()
+        self._written = dict()      # table -> 最后一次被修改的时间
+
+    # 键中包含表当前的版本号;select在查询之前取得键,若查询期间表被修改,
+    # 查询到的旧数据会以旧版本号放入缓存,不会被之后的查询命中
+    def key(self, table, sql, args, size, tuples=False):
+        return (table, self._versions.get(table, 0), sql, tuple(args or ()), size, tuples)
+
+    def get(self, key):
+        item = self._results.get(key, None)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._results[key]
+            self.misses = self.misses + 1
+            return None
+        self._results.move_to_end(key)
+        self.hits = self.hits + 1
+        # 返回列表的副本,调用者修改列表不会影响缓存
+        return list(item[1])
+
+    def put(self, key, rows, ttl):
+        if len(rows) > self.maxrows:
+            return
+        self._results[key] = (time.monotonic() + ttl, list(rows))
+        self._results.move_to_end(key)
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+
+    def invalidate(self, table):
+        self._versions[table] = self._versions.get(table, 0) + 1
+        self._written[table] = time.monotonic()
+
+    # 表最近window秒内没有被修改过;在此之前副本可能还没有复制到最新的修改,从副本读到的结果不能缓存
+    def settled(self, table, window):
+        written = self._written.get(table, None)
+        return written is None or time.monotonic() - written >= window
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._results))
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self._results.clear()
+        self._written.clear()
+
+_results = ResultCache()
+
+# 表被修改后调用,使这张表的缓存结果全部失效
+# 在事务中时,提交事务时会再调用一次,避免其他请求在提交之前把旧数据重新放入缓存
+def invalidate(table):
+    _results.invalidate(table)
+    tx = current_transaction()
+    if tx is not None:
+        tx.tables.add(table)
+
+# 写入监听:listen(Blog, callback)后,Blog对象每次save/save_many/update/remove成功后调用
+#   callback(action, obj, fields)
+# action为'save','update'或'remove',fields为update写入的列(其他操作为None)
+# 在事务中时,提交之后才调用,回滚时丢弃;callback在事件循环中同步执行,不应阻塞
+_listeners = dict()
+
+def listen(model, callback):
+    _listeners.setdefault(model, []).append(callback)
+
+def unlisten(model, callback):
+    callbacks = _listeners.get(model, None)
+    if callbacks and callback in callbacks:
+        callbacks.remove(callback)
+
+def _notify(obj, action, fields=None):
+    callbacks = _listeners.get(obj.__class__, None)
+    if not callbacks:
+        return
+    tx = current_transaction()
+    if tx is not None:
+        tx.events.append((obj, action, fields))
+        return
+    _dispatch(obj, action, fields)
+
+def _dispatch(obj, action, fields):
+    for callback in list(_listeners.get(obj.__class__, ())):
+        try:
+            callback(action, obj, fields)
+        except Exception as e:
+            logging.exception(e)
+
+# 返回结果缓存的命中/未命中统计
+def result_stats():
+    return _results.stats()
+
+# 计数缓存:在内存中保存各表(以及各where子句)的记录数,供分页使用,避免每次都执行count(*)
+# Model的save/save_many/remove插入或删除记录时增量更新:
+#   整表计数直接加减;where子句是"`col`=? and ..."这样的简单相等条件时,用新旧记录判断是否满足条件后加减;
+#   其他where子句无法判断,直接丢弃该表的这些计数,下次重新查询
+# 计数在ttl秒后过期,以纠正其他进程或直接execute()造成的偏差
+# 表很大时(统计信息中的行数不少于approximate),整表计数直接使用information_schema中的近似行数
+class CountCache(object):
+
+    def __init__(self, ttl=300, approximate=1000000):
+        self.ttl = ttl
+        self.approximate = approximate
+        self.hits = 0
+        self.misses = 0
+        self._counts = dict()       # (table, where, args) -> [count, 过期时间]
+        self._tables = dict()       # table -> 该表的所有计数的键
+        self._generations = dict()  # table -> 该表的计数被修改的次数
+        self._changed = dict()      # table -> 该表最后一次被修改的时间
+        self._columns = dict()      # where -> where中相等条件的列,无法解析时为None
+
+    def key(self, table, where, args):
+        return (table, where, tuple(args or ()))
+
+    def generation(self, table):
+        return self._generations.get(table, 0)
+
+    def _bump(self, table):
+        self._generations[table] = self.generation(table) + 1
+        self._changed[table] = time.monotonic()
+
+    def get(self, key):
+        item = self._counts.get(key, None)
+        if item is None or item[1] < time.monotonic():
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        return item[0]
+
+    # generation为查询之前取得的值,若查询期间该表有过插入或删除,查询结果可能已经不准确,不放入缓存
+    # lag为副本的复制延迟上限(秒),该表在这段时间内被修改过时,从副本查到的计数可能还是旧的,也不放入缓存
+    def put(self, key, count, generation, lag=0):
+        if generation != self.generation(key[0]):
+            return
+        changed = self._changed.get(key[0], None)
+        if lag and changed is not None and time.monotonic() - changed < lag:
+            return
+        self._counts[key] = [count, time.monotonic() + self.ttl]
+        self._tables.setdefault(key[0], set()).add(key)
+
+    _RE_EQUAL = re.compile(r'^`?(\w+)`?\s*=\s*\?$')
+
+    # 解析"`a`=? and b=?"这样的where子句,返回相等条件的列;无法解析时返回None
+    def _where_columns(self, where):
+        try:
+            return self._columns[where]
+        except KeyError:
+            pass
+        columns = []
+        for cond in re.split(r'\s+and\s+', where.strip(), flags=re.I):
+            m = self._RE_EQUAL.match(cond.strip())
+            if m is None:
+                columns = None
+                break
+            columns.append(m.group(1))
+        self._columns[where] = tuple(columns) if columns is not None else None
+        return self._columns[where]
+
+    # 插入(delta=1)或删除(delta=-1)了记录objs
+    def apply(self, table, objs, delta):
+        self._bump(table)
+        for key in list(self._tables.get(table, ())):
+            where, args = key[1], key[2]
+            if where is None:
+                self._counts[key][0] = self._counts[key][0] + delta * len(objs)
+                continue
+            columns = self._where_columns(where)
+            if columns is None or len(columns) != len(args):
+                self._drop(key)
+                continue
+            # where的参数可能来自url(字符串),与对象的值比较之前都按列的类型转换(例如BigIntField转换为int)
+            mappings = objs[0].__mappings__ if objs else dict()
+            try:
+                if any(c not in mappings for c in columns):
+                    raise ValueError(where)
+                args = [mappings[c].convert(a) for c, a in zip(columns, args)]
+                matched = 0
+                for obj in objs:
+                    if all(mappings[c].convert(getattr(obj, c, None)) == a for c, a in zip(columns, args)):
+                        matched = matched + 1
+            except (ValueError, TypeError):
+                # 无法转换时不能判断是否满足条件,丢弃这个计数
+                self._drop(key)
+                continue
+            self._counts[key][0] = self._counts[key][0] + delta * matched
+
+    # 更新了记录的fields列,丢弃where子句中涉及这些列的计数
+    def changed(self, table, fields):
+        self._bump(table)
+        for key in list(self._tables.get(table, ())):
+            if key[1] is None:
+                continue
+            columns = self._where_columns(key[1])
+            if columns is None or any(c in fields for c in columns):
+                self._drop(key)
+
+    def _drop(self, key):
+        self._counts.pop(key, None)
+        self._tables.get(key[0], set()).discard(key)
+
+    def invalidate(self, table):
+        self._bump(table)
+        for key in list(self._tables.pop(table, ())):
+            self._counts.pop(key, None)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._counts))
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        for table in list(self._tables):
+            self.invalidate(table)
+        self._changed.clear()
+
+_counts = CountCache()
+
+# 返回计数缓存的命中/未命中统计
+def count_stats():
+    return _counts.stats()
+
+# 慢查询日志:耗时超过threshold秒的语句保存在一个最多maxsize条的环形缓冲区中,新的记录挤掉最旧的
+# 每条记录包含语句的指纹(把字面量和in列表归一后的sql,同一类查询的指纹相同),耗时和时间
+# 慢的select会在后台用EXPLAIN取得执行计划,按指纹只取一次,计划保存在记录的plan中
+# 参数中可能有密码等数据,不保存在记录中
+class SlowQueryLog(object):
+
+    _RE_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+    _RE_NUMBER = re.compile(r'\b\d+(\.\d+)?\b')
+    _RE_IN = re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)')
+    _RE_SPACE = re.compile(r'\s+')
+
+    def __init__(self, threshold=0.1, maxsize=100, explain=True, maxplans=256):
+        self.threshold = threshold
+        self.explain = explain
+        self.maxplans = maxplans
+        self._queries = collections.deque(maxlen=maxsize)
+        self._plans = OrderedDict()
+        self.count = 0
+
+    # 返回sql的指纹
+    def fingerprint(self, sql):
+        sql = self._RE_STRING.sub('?', sql)
+        sql = self._RE_NUMBER.sub('?', sql)
+        sql = self._RE_IN.sub('(?+)', sql)
+        return self._RE_SPACE.sub(' ', sql).strip().lower()
+
+    # 由select/execute在每条语句执行完后调用,超过期限被终止的语句timed_out为True,总是记录
+    def observe(self, sql, args, seconds, timed_out=False):
+        if self.threshold is None or (seconds < self.threshold and not timed_out):
+            return
+        self.count = self.count + 1
+        DB_SLOW_QUERIES.inc(_statement_type(sql))
+        fingerprint = self.fingerprint(sql)
+        logging.warn('slow query (%.3fs%s): %s' % (seconds, ', timed out' if timed_out else '', sql))
+        entry = dict(fingerprint=fingerprint, sql=sql, seconds=seconds, time=time.time(), timed_out=timed_out, plan=self._plans.get(fingerprint, None))
+        self._queries.append(entry)
+        if self.explain and _statement_type(sql) == 'select' and fingerprint not in self._plans:
+            # 先占位,避免同一类查询同时触发多次EXPLAIN
+            self._plans[fingerprint] = None
+            while len(self._plans) > self.maxplans:
+                self._plans.popitem(last=False)
+            asyncio.ensure_future(self._explain(fingerprint, sql, args))
+
+    @asyncio.coroutine
+    def _explain(self, fingerprint, sql, args):
+        try:
+            pool = _read_pool()
+            conn = yield from _checkout(pool)
+            try:
+                plan = yield from _select(conn, _backend.explain_prefix + sql, args, None)
+            finally:
+                pool.release(conn)
+        except Exception as e:
+            logging.warn('failed to explain %s: %s' % (sql, e))
+            self._plans.pop(fingerprint, None)
+            return
+        self._plans[fingerprint] = plan
+        for entry in self._queries:
+            if entry['fingerprint'] == fingerprint:
+                entry['plan'] = plan
+
+    # 返回缓冲区中的慢查询,最近的在前
+    def queries(self):
+        return [dict(entry) for entry in reversed(self._queries)]
+
+    def stats(self):
+        return dict(count=self.count, size=len(self._queries))
+
+    def clear(self):
+        self.count = 0
+        self._queries.clear()
+        self._plans.clear()
+
+_slow_queries = SlowQueryLog()
+
+# 返回最近的慢查询
+def slow_queries():
+    return _slow_queries.queries()
 
 # 创建全局数据库连接池,使每个http请求都能从连接池中直接获取数据库连接
 # 避免频繁地打开或关闭数据库连接
+# configs.db中可以指定replicas(只读副本的列表),每一项只需写出与主库不同的配置(通常是host和port)
+# 此时select被分发到各个副本,增删改仍然走主库;sticky为True(默认)时,
+# 一个Task(即一个请求)在写入之后的读操作也走主库,避免因复制延迟读不到自己刚写入的数据
+# 同一会话的后续请求(例如POST之后的重定向)由app.py的sticky_factory通过cookie调用read_primary(),
+# 在写入后的sticky_window秒内也读主库
+# backend为'mysql'(默认)或'sqlite',使用sqlite时db为数据库文件的路径,不需要user和password
 @asyncio.coroutine
 def create_pool(loop, **kw):
     logging.info('create database connection pool...')
-    global __pool # 定义全局变量
-    # 调用一个子协程来创建全局连接池,creste_pool的返回值是一个pool实例对像
-    __pool = yield from aiomysql.create_pool(
-        # 前面几项为设置连接的属性
-        host=kw.get('host', 'localhost'),     # 数据库服务器的位置,
-        port=kw.get('port', 3306),            # mysql的端口
-        user=kw['user'],                      # 登录用户名
-        password=kw['password'],              # 密码
-        db=kw['db'],                          # 当前数据库名
-        charset=kw.get('charset', 'utf8'),    # 设置连接使用的编码格式为utf-8
-        autocommit=kw.get('autocommit', True),# 自动提交模式,默认是False
-
-        # 下面三项是可选项
-        maxsize=kw.get('maxsize', 10),  # 最大连接池大小,默认是10
-        minsize=kw.get('minsize', 1),   # 最小连接池大小,默认是10
-        loop=loop    # 设置消息循环
-    )
+    global __pool, __replicas, _sticky, _sticky_window, _acquire_timeout, _query_timeout, _backend # 定义全局变量
+    _backend = backends.get_backend(kw.get('backend', 'mysql'))
+    # 换了数据库之后,之前缓存的语句,结果和计数都不再可用
+    _statements.clear()
+    _statements.placeholder = _backend.placeholder
+    _results.clear()
+    _counts.clear()
+    _slow_queries.clear()
+    _loaders.clear()
+    # 慢查询的阈值(秒),为None时不记录;slow_query_explain为False时不取执行计划
+    _slow_queries.threshold = kw.get('slow_query_threshold', 0.1)
+    _slow_queries.explain = kw.get('slow_query_explain', True)
+    __pool = yield from _open_pool(loop, 'primary', kw)
+    replicas = []
+    for replica in kw.get('replicas', None) or []:
+        logging.info('create replica connection pool: %s:%s' % (replica.get('host', 'localhost'), replica.get('port', 3306)))
+        options = dict(kw)
+        options.update(replica)
+        replicas.append((yield from _open_pool(loop, 'replica%d' % len(replicas), options)))
+    __replicas = replicas
+    _sticky = kw.get('sticky', True)
+    _sticky_window = kw.get('sticky_window', 5)
+    # 等待空闲连接的最长时间(秒),默认一直等待
+    _acquire_timeout = kw.get('acquire_timeout', None)
+    # 每条语句默认的期限(秒),默认不限制,见_with_deadline
+    _query_timeout = kw.get('query_timeout', None)
+
+# 停止连接池的维护并关闭所有连接
+@asyncio.coroutine
+def close_pool():
+    global __pool, __replicas
+    for keeper in _keepers.values():
+        keeper.stop()
+    _keepers.clear()
+    for name, pool in _pools():
+        pool.close()
+        yield from pool.wait_closed()
+    __pool = None
+    __replicas = []
+
+# 按schema.sql建表,默认使用与orm.py同目录下的schema.sql
+# 建库和授权等语句会被跳过,sqlite中表内的key会被转换为create index
+@asyncio.coroutine
+def create_schema(path=None):
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+    with open(path, 'r', encoding='utf-8') as f:
+        schema = f.read()
+    for stmt in _backend.schema_statements(schema):
+        yield from execute(stmt, ())
+
+# 按模型生成建表语句(包括索引),models默认为所有已定义的模型
+def schema_statements(models=None):
+    if models is None:
+        models = sorted(_models.values(), key=lambda m: m.__table__)
+    return _backend_or_default().schema_statements(';\n'.join([m.__create_table__ for m in models]))
+
+# 在连接池创建之前(例如只生成DDL时)使用mysql的语法
+def _backend_or_default():
+    return _backend if _backend is not None else backends.Backend()
+
+# 对照数据库中已有的索引,找出模型中声明了但数据库中还没有的索引,返回[(模型, 建立索引的语句), ...]
+# 已有索引的前几列与声明的列相同时即认为已经满足(最左前缀);唯一索引则要求已有的索引是唯一的且列完全相同
+@asyncio.coroutine
+def missing_indexes(models=None):
+    if models is None:
+        models = sorted(_models.values(), key=lambda m: m.__table__)
+    missing = []
+    for model in models:
+        rs = yield from select(_backend.index_columns_sql, [model.__table__])
+        existing = dict()
+        for r in rs:
+            existing.setdefault(r['_index_'], ([], bool(r['_unique_'])))[0].append(r['_column_'])
+        for name, columns, unique in model.__index_defs__:
+            for cols, u in existing.values():
+                if (unique and u and tuple(cols) == columns) or (not unique and tuple(cols[:len(columns)]) == columns):
+                    break
+            else:
+                logging.warn('missing index %s on %s%s' % (name, model.__table__, str(columns)))
+                missing.append((model, _backend.schema_statements(model.__create_indexes__[name])[0]))
+    return missing
+
+# 返回数据库中table.column的类型(小写,例如'bigint(20)'或'varchar(50)'),表或列不存在时返回None
+@asyncio.coroutine
+def column_type(table, column):
+    rs = yield from select(_backend.column_type_sql, [table, column], 1)
+    if len(rs) == 0:
+        return None
+    return rs[0]['_type_'].lower()
+
+# 返回[(名称, 连接池), ...],名称用作监控指标的标签
+def _pools():
+    return [(_pool_names.get(pool, 'primary'), pool) for pool in [__pool] + __replicas if pool is not None]
+
+# 写操作使用的连接池(主库)
+def _write_pool():
+    return __pool
+
+# 读操作使用的连接池
+# 在各个副本中选择正在使用的连接数最少的一个,数量相同时轮流选择
+def _read_pool():
+    global _next_replica
+    if not __replicas:
+        return __pool
+    if _sticky and _sticky_tasks:
+        task = _current_task()
+        if task is not None and task in _sticky_tasks:
+            return __pool
+    n = len(__replicas)
+    start = _next_replica
+    _next_replica = (start + 1) % n
+    best = None
+    for i in range(n):
+        pool = __replicas[(start + i) % n]
+        if best is None or pool.size - pool.freesize < best.size - best.freesize:
+            best = pool
+    return best
+
+# 连接池和查询的监控指标,通过handlers中的/metrics以Prometheus的文本格式输出
+# 默认maxsize=10时,连接池耗尽表现为db_pool_waiting上升和db_pool_checkout_wait_seconds变长
+def _pool_samples():
+    samples = []
+    for name, pool in _pools():
+        samples.append(((name, 'in_use'), pool.size - pool.freesize))
+        samples.append(((name, 'free'), pool.freesize))
+        samples.append(((name, 'max'), pool.maxsize))
+    return samples
+
+def _cache_samples():
+    samples = []
+    for name, stats in (('statement', _statements.stats()), ('result', _results.stats()), ('count', _counts.stats())):
+        for k in ('hits', 'misses', 'size'):
+            samples.append(((name, k), stats[k]))
+    return samples
+
+DB_POOL_CONNECTIONS = metrics.Gauge('db_pool_connections', 'Connections of the pool by state.', ('pool', 'state'), callback=_pool_samples)
+DB_POOL_WAITING = metrics.Gauge('db_pool_waiting', 'Tasks waiting for a pooled connection.', ('pool',))
+DB_POOL_WAIT = metrics.Histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection.', ('pool',))
+DB_POOL_TIMEOUTS = metrics.Counter('db_pool_checkout_timeouts_total', 'Checkouts that timed out waiting for a connection.', ('pool',))
+DB_QUERY_SECONDS = metrics.Histogram('db_query_duration_seconds', 'Query latency by statement type.', ('type',))
+DB_QUERY_TIMEOUTS = metrics.Counter('db_query_timeouts_total', 'Queries that exceeded their deadline and were killed.', ('type',))
+DB_QUERY_ERRORS = metrics.Counter('db_query_errors_total', 'Failed queries by statement type.', ('type',))
+DB_SLOW_QUERIES = metrics.Counter('db_slow_queries_total', 'Queries slower than the slow query threshold.', ('type',))
+ORM_CACHE = metrics.Gauge('orm_cache', 'Hits, misses and size of the orm caches.', ('cache', 'stat'), callback=_cache_samples)
+
+# 从连接池中取出一条连接,记录等待的时间;超过acquire_timeout时抛出asyncio.TimeoutError
+# 取出的连接用完后必须通过pool.release(conn)归还
+@asyncio.coroutine
+def _checkout(pool):
+    name = _pool_names.get(pool, 'primary')
+    start = time.monotonic()
+    DB_POOL_WAITING.inc(name)
+    try:
+        if _acquire_timeout:
+            conn = yield from asyncio.wait_for(pool.acquire(), _acquire_timeout)
+        else:
+            conn = yield from pool.acquire()
+    except asyncio.TimeoutError:
+        DB_POOL_TIMEOUTS.inc(name)
+        raise
+    finally:
+        DB_POOL_WAITING.dec(name)
+    wait = time.monotonic() - start
+    DB_POOL_WAIT.observe(wait, name)
+    keeper = _keepers.get(name, None)
+    if keeper is not None:
+        keeper.observe(wait)
+    return conn
+
+# 返回sql语句的类型(select, insert, update, delete等),用作监控指标的标签
+def _statement_type(sql):
+    return sql.split(None, 1)[0].lower()
+
+# 当前Task写入过数据,之后的读操作需要走主库
+def _reads_primary():
+    return bool(__replicas and _sticky and _sticky_tasks and _current_task() in _sticky_tasks)
+
+# 副本的复制延迟上限(秒):表修改后的这段时间内从副本读到的结果可能是旧的,不能放入缓存
+def _replica_lag():
+    return _sticky_window if __replicas else 0
+
+# 记录当前Task发生过写操作
+def _mark_written():
+    if __replicas and _sticky:
+        task = _current_task()
+        if task is not None:
+            _sticky_tasks.add(task)
+            _written_tasks.add(task)
+
+# 当前Task之后的读操作走主库,用于会话中刚写入过数据的请求
+def read_primary():
+    if __replicas and _sticky:
+        task = _current_task()
+        if task is not None:
+            _sticky_tasks.add(task)
+
+# 清除当前Task的读主库和写入标记
+# 旧版aiohttp的keep-alive连接上的多个请求在同一个Task中处理,每个请求结束时都要调用,否则标记会延续到后续的请求
+def reset_sticky():
+    task = _current_task()
+    if task is not None:
+        _sticky_tasks.discard(task)
+        _written_tasks.discard(task)
+
+# 当前Task写入过数据时返回之后还需要读主库的秒数(sticky_window),否则返回0
+# 没有配置副本或sticky为False时总是返回0
+def written():
+    if _written_tasks and _current_task() in _written_tasks:
+        return _sticky_window
+    return 0
 
 # Select 操作 sql形参即为sql语句, args表示填入sql的选项值
 # size用于指定最大的查询数量,不指定将返回所有查询结果
+# 指定了table和ttl(秒)时,结果会被缓存ttl秒,直到table被修改为止
+# tuples为True时每一行是按select中列的顺序排列的元组,不为每一行构造dict,用于Model的快速构造
+# 缓存中的行会被多次返回,调用者不能修改返回的行
+# timeout为这条语句的期限(秒),超过时抛出QueryTimeoutError,None表示使用create_pool的query_timeout,0表示不限制
 @asyncio.coroutine
-def select(sql, args, size=None):  # async协程
+def select(sql, args, size=None, table=None, ttl=None, tuples=False, timeout=None):  # async协程
     log(sql, args)
-    global __pool
+    # 在事务中时使用事务的连接,这样可以读到事务内尚未提交的修改,此时也不使用缓存
+    tx = current_transaction()
+    if tx is not None:
+        return (yield from _select(tx.conn, sql, args, size, tuples, timeout))
+    # 写入后需要读主库的请求不使用缓存:缓存中可能是其他请求从副本读到的旧数据
+    if ttl and _reads_primary():
+        ttl = None
+    if ttl:
+        key = _results.key(table, sql, args, size, tuples)
+        rs = _results.get(key)
+        if rs is not None:
+            return rs
     # 从连接池中获取一条数据连接
-    with (yield from __pool) as conn:
-        # 打开一个DictCursor,它与普通游标的不同在于,以dict形式返回结果
-        cur = yield from conn.cursor(aiomysql.DictCursor)
-        # sql语句的占位符为"?",mysql的占位符为"%s",因此需要进行替换
+    pool = _read_pool()
+    conn = yield from _checkout(pool)
+    try:
+        rs = yield from _select(conn, sql, args, size, tuples, timeout)
+    finally:
+        pool.release(conn)
+    # 表修改后的sticky_window秒内,副本可能还有复制延迟,读到的旧数据会以新的版本号被缓存整个ttl,因此不缓存
+    if ttl and (pool is __pool or _results.settled(table, _sticky_window)):
+        _results.put(key, rs, ttl)
+    return rs
+
+@asyncio.coroutine
+def _select(conn, sql, args, size, tuples=False, timeout=None):
+    @asyncio.coroutine
+    def run():
+        # 打开一个DictCursor,它与普通游标的不同在于,以dict形式返回结果;tuples为True时使用普通游标
+        if tuples:
+            cur = yield from conn.cursor()
+        else:
+            cur = yield from conn.cursor(_backend.DictCursor)
+        # sql语句的占位符为"?",mysql的占位符为"%s",因此需要进行替换(替换结果由_statements缓存)
         # 若没有指定args,将使用默认的select语句(在Meatclass内定义的)进行查询
-        yield from cur.execute(sql.replace('?', '%s'), args or ())
+        yield from cur.execute(_statements.prepare(sql), args or ())
         if size:
             rs = yield from cur.fetchmany(size)
         else:
             rs = yield from cur.fetchall()
         yield from cur.close()
-        logging.info('rows returned: %s' % len(rs))
         return rs
+    start = time.monotonic()
+    try:
+        rs = yield from _with_deadline(conn, run(), sql, timeout)
+    except BaseException as e:
+        DB_QUERY_ERRORS.inc(_statement_type(sql))
+        if isinstance(e, QueryTimeoutError):
+            # 最慢的语句正是超时的语句,同样记入慢查询日志并取得执行计划
+            _slow_queries.observe(sql, args, time.monotonic() - start, True)
+        raise
+    finally:
+        elapsed = time.monotonic() - start
+        DB_QUERY_SECONDS.observe(elapsed, _statement_type(sql))
+    _slow_queries.observe(sql, args, elapsed)
+    _sql_log.info('rows returned', rows=len(rs), seconds=elapsed)
+    return rs
+
+# 语句超过期限时抛出,此时服务器上的语句已被终止(KILL QUERY)
+class QueryTimeoutError(Exception):
+
+    def __init__(self, sql, timeout):
+        super(QueryTimeoutError, self).__init__('Query timed out after %ss: %s' % (timeout, sql))
+        self.sql = sql
+        self.timeout = timeout
+
+# 终止语句后等待它返回的时间(秒),以及执行KILL QUERY本身的期限
+KILL_GRACE = 1.0
+
+# 在期限内执行coro(一条语句在conn上的全部读写)
+# 语句直接在当前Task中执行,只用loop.call_later设置一个定时器,语句返回时取消,不为每条语句另建Task
+# 超时后先让数据库终止服务器上的语句,语句会带着错误返回,连接仍然可用,之后正常归还给连接池;
+# 若在KILL_GRACE秒内仍未返回,取消当前Task中的读写并关闭连接(连接池会丢弃关闭的连接),避免把状态不明的连接还给连接池
+@asyncio.coroutine
+def _with_deadline(conn, coro, sql, timeout):
+    if timeout is None:
+        timeout = _query_timeout
+    if not timeout:
+        try:
+            return (yield from coro)
+        except asyncio.CancelledError:
+            conn.close()
+            raise
+    loop = asyncio.get_event_loop()
+    task = _current_task()
+    # expired: 已超时; aborted: 终止后仍未返回,已取消task; done: 语句已返回
+    state = dict(expired=False, aborted=False, done=False, timer=None)
+
+    def abort():
+        state['timer'] = None
+        if not state['done']:
+            state['aborted'] = True
+            task.cancel()
+
+    @asyncio.coroutine
+    def kill():
+        try:
+            yield from asyncio.wait_for(_backend.kill_query(conn), KILL_GRACE)
+        except Exception as e:
+            logging.warn('failed to kill query: %s' % e)
+        if not state['done']:
+            state['timer'] = loop.call_later(KILL_GRACE, abort)
+
+    def expire():
+        state['timer'] = None
+        state['expired'] = True
+        DB_QUERY_TIMEOUTS.inc(_statement_type(sql))
+        logging.warn('query timed out after %ss, killing it: %s' % (timeout, sql))
+        # KILL QUERY需要另一条连接,只有超时时才在后台执行
+        asyncio.ensure_future(kill())
+
+    state['timer'] = loop.call_later(timeout, expire)
+    try:
+        result = yield from coro
+    except asyncio.CancelledError:
+        # 语句的状态不明(被abort取消,或调用者被取消,例如客户端断开),关闭连接
+        conn.close()
+        if state['aborted']:
+            raise QueryTimeoutError(sql, timeout)
+        raise
+    except Exception:
+        # 语句已返回(通常是被终止的错误)
+        if state['expired']:
+            raise QueryTimeoutError(sql, timeout)
+        raise
+    finally:
+        state['done'] = True
+        if state['timer'] is not None:
+            state['timer'].cancel()
+    if state['expired']:
+        raise QueryTimeoutError(sql, timeout)
+    return result
+
+# 插入或更新时违反了主键或唯一索引,key为重复的键(索引名或列名,取决于数据库)
+class DuplicateKeyError(Exception):
+
+    def __init__(self, key):
+        super(DuplicateKeyError, self).__init__('Duplicate key: %s' % key)
+        self.key = key
 
 # 增删改的是对数据库的修改,因此封装在一个函数中
 @asyncio.coroutine
-def execute(sql, args, autocommit=True):
+def execute(sql, args, autocommit=True, timeout=None):
     log(sql)
-    with (yield from __pool) as conn:
+    # 在事务中时直接使用事务的连接,由事务统一提交或回滚
+    tx = current_transaction()
+    if tx is not None:
+        return (yield from _execute(tx.conn, sql, args, timeout))
+    _mark_written()
+    pool = _write_pool()
+    conn = yield from _checkout(pool)
+    try:
         if not autocommit:
             yield from conn.begin()
         try:
-            # 此处打开的是一个普通游标
-            cur = yield from conn.cursor()
-            yield from cur.execute(sql.replace('?', '%s'), args)
-            affected = cur.rowcount # 增删改,返回影响的行数
-            yield from cur.close()
+            affected = yield from _execute(conn, sql, args, timeout)
             if not autocommit:
                 yield from conn.commit()
         except BaseException as e:
-            if not autocommit:
+            # 超时后连接可能已被关闭,此时数据库会自行回滚
+            if not autocommit and not conn.closed:
                 yield from conn.rollback()
             raise
         return affected
+    finally:
+        pool.release(conn)
+
+@asyncio.coroutine
+def _execute(conn, sql, args, timeout=None):
+    @asyncio.coroutine
+    def run():
+        # 此处打开的是一个普通游标
+        cur = yield from conn.cursor()
+        yield from cur.execute(_statements.prepare(sql), args)
+        affected = cur.rowcount # 增删改,返回影响的行数
+        yield from cur.close()
+        return affected
+    start = time.monotonic()
+    try:
+        affected = yield from _with_deadline(conn, run(), sql, timeout)
+    except BaseException as e:
+        DB_QUERY_ERRORS.inc(_statement_type(sql))
+        if isinstance(e, QueryTimeoutError):
+            _slow_queries.observe(sql, args, time.monotonic() - start, True)
+        # 驱动的重复键错误统一转换为DuplicateKeyError
+        key = _backend.duplicate_key(e) if isinstance(e, Exception) else None
+        if key is not None:
+            raise DuplicateKeyError(key) from e
+        raise
+    finally:
+        elapsed = time.monotonic() - start
+        DB_QUERY_SECONDS.observe(elapsed, _statement_type(sql))
+    _slow_queries.observe(sql, args, elapsed)
+    return affected
+
+# 事务:从主库取出一条连接并绑定到当前的Task上,事务内的select/execute
+# (包括Model的save/update/remove等)都使用这条连接,最后只提交一次
+# 在async def定义的协程中:
+#     async with orm.transaction():
+#         await blog.save()
+#         await comment.save()
+# 在@asyncio.coroutine的生成器协程中(例如handlers中的处理函数)不能使用async with,显式调用:
+#     tx = orm.transaction()
+#     yield from tx.begin()
+#     try:
+#         yield from blog.save()
+#         yield from comment.save()
+#     except BaseException:
+#         yield from tx.rollback()
+#         raise
+#     yield from tx.commit()
+# 正常结束时提交,发生异常时回滚;嵌套使用时内层事务并入外层事务
+# 注意:流式查询(RowIterator)总是使用独立的连接;在事务内用asyncio.ensure_future等创建的新Task不在事务中
+class Transaction(object):
+
+    def __init__(self):
+        self.conn = None
+        self._pool = None
+        self._task = None
+        self._joined = False
+        # 事务中修改过的表,提交时使它们的缓存结果失效
+        self.tables = set()
+        # 事务中的写入事件,提交后通知监听者,见listen
+        self.events = []
+
+    @asyncio.coroutine
+    def begin(self):
+        task = _current_task()
+        if task is None:
+            raise RuntimeError('transaction must be used inside a task.')
+        if current_transaction() is not None:
+            # 已经处于事务中,并入外层事务
+            self._joined = True
+            return self
+        _mark_written()
+        self._pool = _write_pool()
+        self.conn = yield from _checkout(self._pool)
+        try:
+            yield from self.conn.begin()
+        except BaseException:
+            self._close()
+            raise
+        self._task = task
+        _transactions[task] = self
+        return self
+
+    @asyncio.coroutine
+    def commit(self):
+        if self._joined:
+            return
+        try:
+            yield from self.conn.commit()
+        finally:
+            self._close()
+        for table in self.tables:
+            _results.invalidate(table)
+        for event in self.events:
+            _dispatch(*event)
+
+    @asyncio.coroutine
+    def rollback(self):
+        if self._joined:
+            return
+        try:
+            # 语句超时后连接可能已被_with_deadline关闭,关闭的连接上没有需要回滚的事务(服务器会自动回滚)
+            # 不再调用rollback,调用者得到的仍是原来的QueryTimeoutError
+            if not self.conn.closed:
+                yield from self.conn.rollback()
+        finally:
+            self._close()
+        # 事务中对计数的增量更新随事务一起作废
+        for table in self.tables:
+            _counts.invalidate(table)
+
+    def _close(self):
+        if self._task is not None:
+            _transactions.pop(self._task, None)
+            self._task = None
+        if self.conn is not None:
+            self._pool.release(self.conn)
+            self.conn = None
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return (yield from self.begin())
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            yield from self.commit()
+        else:
+            yield from self.rollback()
+        return False
+
+_transactions = weakref.WeakKeyDictionary()
+
+def transaction():
+    return Transaction()
+
+# 返回当前Task所在的事务,没有则返回None
+def current_transaction():
+    if not _transactions:
+        return None
+    task = _current_task()
+    if task is None:
+        return None
+    return _transactions.get(task, None)
+
+# 流式查询:使用非缓冲(服务端)游标,每次只从mysql读取batch行
+# 导出,重建索引,生成sitemap等需要遍历整张表的任务,内存占用不随表的大小增长
+# 既可以通过 "rows = yield from it.fetch()" 分批读取,也可以使用 "async for row in it" 逐行遍历
+# 遍历期间独占一条连接,提前结束(break,异常)时必须close(),否则连接不会归还给连接池:
+#     async with Blog.iter_all() as it:
+#         async for blog in it:
+#             ...
+# 基于生成器的协程中使用try/finally:
+#     it = Blog.iter_all()
+#     try:
+#         rows = yield from it.fetch()
+#         ...
+#     finally:
+#         yield from it.close()
+class RowIterator(object):
+
+    # factory用于把每一行(dict)转换为需要的对象,比如Model的子类
+    def __init__(self, sql, args, batch=500, factory=None):
+        if batch < 1:
+            raise ValueError('Invalid batch value:%s' % str(batch))
+        self._sql = sql
+        self._args = args
+        self._batch = batch
+        self._factory = factory
+        self._pool = None
+        self._conn = None
+        self._cur = None
+        self._rows = []
+        self._done = False
+
+    @asyncio.coroutine
+    def _open(self):
+        log(self._sql, self._args)
+        # 整个遍历期间独占一条连接,遍历结束或close()时归还给连接池
+        self._pool = _read_pool()
+        self._conn = yield from _checkout(self._pool)
+        try:
+            self._cur = yield from self._conn.cursor(_backend.SSDictCursor)
+            yield from self._cur.execute(_statements.prepare(self._sql), self._args or ())
+        except BaseException:
+            yield from self.close()
+            raise
+
+    # 读取下一批数据,全部读完后返回空列表
+    @asyncio.coroutine
+    def fetch(self):
+        if self._done:
+            return []
+        if self._conn is None:
+            yield from self._open()
+        try:
+            rs = yield from self._cur.fetchmany(self._batch)
+            if self._factory is not None:
+                rs = [self._factory(r) for r in rs]
+            else:
+                rs = list(rs)
+        except BaseException:
+            yield from self.close()
+            raise
+        if len(rs) < self._batch:
+            yield from self.close()
+        return rs
+
+    # 提前结束遍历时需要调用close,非缓冲游标在关闭时会丢弃剩余的数据
+    @asyncio.coroutine
+    def close(self):
+        self._done = True
+        cur, conn = self._cur, self._conn
+        self._cur = self._conn = None
+        try:
+            if cur is not None:
+                yield from cur.close()
+        except BaseException:
+            # 没能读完剩余的数据,连接的状态不明,关闭它(连接池会丢弃关闭的连接)
+            if conn is not None:
+                conn.close()
+            raise
+        finally:
+            if conn is not None:
+                self._pool.release(conn)
+
+    @asyncio.coroutine
+    def __aenter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __aexit__(self, exc_type, exc, tb):
+        yield from self.close()
+        return False
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if not self._rows:
+            self._rows = yield from self.fetch()
+            if not self._rows:
+                raise StopAsyncIteration
+            self._rows.reverse()
+        return self._rows.pop()
+
+# 标识映射(identity map):在一个请求内,同一个主键只对应一个模型对象
+# 例如cookie2user加载了用户之后,同一请求内再次User.find(uid)将直接返回内存中的对象,不再查询数据库
+# 映射表绑定在当前的asyncio.Task上,aiohttp中每个请求都由一个独立的Task处理,因此即为请求级别
+class IdentityMap(object):
+
+    def __init__(self):
+        self._objects = dict()
+        self.hits = 0
+
+    def get(self, cls, pk):
+        obj = self._objects.get((cls, pk), None)
+        if obj is not None:
+            self.hits = self.hits + 1
+        return obj
+
+    # 加入对象,若同一主键已有对象,返回已有的对象(保留请求中对它的修改)
+    def add(self, obj):
+        key = (obj.__class__, obj.getValue(obj.__primary_key__))
+        return self._objects.setdefault(key, obj)
+
+    def remove(self, obj):
+        self._objects.pop((obj.__class__, obj.getValue(obj.__primary_key__)), None)
+
+    def clear(self):
+        self._objects.clear()
+
+    def __len__(self):
+        return len(self._objects)
+
+_identity_maps = weakref.WeakKeyDictionary()
+
+def _current_task():
+    return asyncio.Task.current_task()
+
+# 把标识映射绑定到当前的Task上,传入None表示解除绑定
+def bind_identity_map(identity_map):
+    task = _current_task()
+    if task is None:
+        raise RuntimeError('bind_identity_map must be called inside a task.')
+    if identity_map is None:
+        _identity_maps.pop(task, None)
+    else:
+        _identity_maps[task] = identity_map
+
+# 返回当前Task绑定的标识映射,没有则返回None
+def current_identity_map():
+    if not _identity_maps:
+        return None
+    task = _current_task()
+    if task is None:
+        return None
+    return _identity_maps.get(task, None)
+
+# 合并同一轮事件循环中对同一模型的find():第一次调用时安排在本轮末尾查询,在此之前各个请求的find()都加入等待,
+# 然后用一条in查询取回所有主键对应的行,每个调用者再由行构造自己的对象,对象不会在请求之间共享
+# 模型设置__batch__ = True时启用;事务中和写入后需要读主库的请求不经过合并,直接查询
+class BatchLoader(object):
+
+    def __init__(self, model):
+        self.model = model
+        self._pending = OrderedDict()
+        self.batches = 0
+        self.keys = 0
+
+    # 返回一个future,结果为主键对应的行(dict)或None
+    def load(self, pk):
+        loop = asyncio.get_event_loop()
+        if not self._pending:
+            loop.call_soon(self._dispatch)
+        fut = asyncio.Future(loop=loop)
+        self._pending.setdefault(pk, []).append(fut)
+        return fut
+
+    def _dispatch(self):
+        pending = self._pending
+        self._pending = OrderedDict()
+        asyncio.ensure_future(self._run(pending))
+
+    @asyncio.coroutine
+    def _run(self, pending):
+        try:
+            rows = yield from self.model._findRows(list(pending.keys()))
+        except Exception as e:
+            for waiters in pending.values():
+                for fut in waiters:
+                    if not fut.done():
+                        fut.set_exception(e)
+            return
+        self.batches = self.batches + 1
+        self.keys = self.keys + len(pending)
+        pk = self.model.__primary_key__
+        found = dict([(row[pk], row) for row in rows])
+        for key, waiters in pending.items():
+            for fut in waiters:
+                # 调用者可能已经被取消
+                if not fut.done():
+                    fut.set_result(found.get(key, None))
+
+    def stats(self):
+        return dict(batches=self.batches, keys=self.keys)
+
+_loaders = dict()
+
+def _loader(cls):
+    loader = _loaders.get(cls, None)
+    if loader is None:
+        loader = _loaders[cls] = BatchLoader(cls)
+    return loader
+
+# 返回各模型合并查询的次数和主键数
+def loader_stats():
+    return dict([(cls.__name__, loader.stats()) for cls, loader in _loaders.items()])
 
 # 构造占位符
 def create_args_string(num):
@@ -81,6 +1274,55 @@ def create_args_string(num):
         L.append('?')
     return ', '.join(L)
 
+# 解析orderBy子句,返回[(列名, 是否降序), ...]
+def _parse_order_by(orderBy):
+    columns = []
+    for item in orderBy.split(','):
+        parts = item.split()
+        if len(parts) == 1:
+            columns.append((parts[0], False))
+        elif len(parts) == 2 and parts[1].lower() in ('asc', 'desc'):
+            columns.append((parts[0], parts[1].lower() == 'desc'))
+        else:
+            raise ValueError('Invalid orderBy value:%s' % orderBy)
+    return columns
+
+# 键集分页:把"排在(c1, c2, ...)=(?, ?, ...)之后"展开为
+#     (c1 > ?) or (c1 = ? and c2 > ?) or ...
+# 而不使用行构造器(c1, c2) > (?, ?),因为较早版本的mysql不能对行构造器的比较使用索引
+# seek为'before'时比较方向和排序方向都取反,返回新的(where, orderBy)
+def _seek_where(where, orderBy, seek):
+    if not orderBy:
+        raise ValueError('orderBy is required by %s.' % seek)
+    columns = _parse_order_by(orderBy)
+    descs = set(desc for col, desc in columns)
+    if len(descs) != 1:
+        raise ValueError('All columns of orderBy must be in the same direction:%s' % orderBy)
+    desc = descs.pop()
+    if seek == 'before':
+        desc = not desc
+    op = '<' if desc else '>'
+    conds = []
+    for i in range(len(columns)):
+        cond = ['%s = ?' % col for col, d in columns[:i]]
+        cond.append('%s %s ?' % (columns[i][0], op))
+        conds.append('(%s)' % ' and '.join(cond))
+    seekWhere = '(%s)' % ' or '.join(conds)
+    if where:
+        seekWhere = '(%s) and %s' % (where, seekWhere)
+    if seek == 'before':
+        orderBy = ', '.join('%s %s' % (col, 'desc' if desc else 'asc') for col, d in columns)
+    return seekWhere, orderBy
+
+# 与_seek_where展开后的占位符一一对应的参数
+def _seek_args(values):
+    values = list(values)
+    args = []
+    for i in range(len(values)):
+        args.extend(values[:i])
+        args.append(values[i])
+    return args
+
 # 父域,可被其他继承
 class Field(object):
 
@@ -88,43 +1330,158 @@ class Field(object):
     # default参数允许orm自己填入省缺值,因此具体的使用请看的具体的类怎么使用
     # 比如User有一个定义在StringField的id,default就用于存储用户的独立id
     # 再比如created_at的default就用于存储创建时间的浮点表示
-    def __init__(self, name, column_type, primary_key, default):
+    # references为这一列引用的模型(类或类名),related_name为被引用的模型上反向关系的名称,见Relation
+    # index/unique为True时为这一列建立普通/唯一索引,多列的索引在模型的__indexes__中声明
+    def __init__(self, name, column_type, primary_key, default, references=None, related_name=None, index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.references = references
+        self.related_name = related_name
+        self.index = index
+        self.unique = unique
 
     # 用于打印信息,依次为类名(域名),属性类型,属性名
     def __str__(self):
         return '<%s, %s:%s> ' % (self.__class__.__name__, self.column_type, self.name)
 
+    # 把外部传入的值(例如url中的id)转换为这一列的类型,find()等按主键查找时使用
+    def convert(self, value):
+        return value
+
 class StringField(Field): # string类型处理,调用父类方法初始化
 
     # ddl("data definition languages"),用于定义数据类型
     # varchar("variable char"), 可变长度的字符串,以下定义中的100表示最长长度,即字符串的可变范围为0~100
     # (char,为不可变长度字符串,会用空格字符补齐)
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', references=None, related_name=None, index=False, unique=False):
+        super().__init__(name, ddl, primary_key, default, references, related_name, index, unique)
 
 class BooleanField(Field):
 
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index=index)
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, references=None, related_name=None, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, references, related_name, index, unique)
+
+# 64位整数主键(以及引用它的列),配合ids.next_id生成的按时间递增的id使用,例如
+#   id = BigIntField(primary_key=True, default=ids.next_id)
+# javascript的数字只能精确表示53位以内的整数,因此toDict()把这些列的值转换为字符串
+class BigIntField(Field):
+
+    def __init__(self, name=None, primary_key=False, default=None, references=None, related_name=None, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, references, related_name, index, unique)
+
+    def convert(self, value):
+        if isinstance(value, str):
+            return int(value)
+        return value
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False, unique=False):
+        super().__init__(name, 'real', primary_key, default, index=index, unique=unique)
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    # 较长的文本可以使用ddl='mediumtext'
+    def __init__(self, name=None, default=None, ddl='text'):
+        super().__init__(name, ddl, False, default)
+
+
+# 模型之间的关系,由列的references声明,例如Comment中:
+#   blog_id = BigIntField(references='Blog', related_name='comments')
+# 会得到两个关系:
+#   Comment.blog: 多对一,名称为列名去掉'_id',值为一个Blog对象(或None)
+#   Blog.comments: 一对多,名称为related_name(默认为引用方的表名),值为Comment对象的列表
+# 关系不会在访问属性时自动查询,而是通过findAll(prefetch=[...])或Model.prefetch()对整个结果集批量加载
+class Relation(object):
+
+    def __init__(self, name, target, local, remote, many):
+        self.name = name        # 关系名,加载后作为对象的属性名
+        self.target = target    # 关联的模型
+        self.local = local      # 本模型中用于关联的列
+        self.remote = remote    # 关联模型中对应的列
+        self.many = many        # 一对多时为True
+
+    # 为objs加载关联的对象:收集各对象的关联值,用in查询一次取回,再按值分配给各个对象
+    @asyncio.coroutine
+    def load(self, objs, orderBy=None):
+        keys = []
+        seen = set()
+        for obj in objs:
+            k = getattr(obj, self.local, None)
+            if k is not None and k not in seen:
+                seen.add(k)
+                keys.append(k)
+        found = dict()
+        identity_map = current_identity_map()
+        if not self.many and identity_map is not None:
+            # 多对一时,本次请求中已经完整加载过的对象不再查询
+            missing = []
+            for k in keys:
+                obj = identity_map.get(self.target, k)
+                if obj is not None and not obj.unloadedFields():
+                    found[k] = obj
+                else:
+                    missing.append(k)
+            keys = missing
+        for i in range(0, len(keys), MAX_IN_VALUES):
+            rs = yield from self.target._findIn(self.remote, keys[i:i + MAX_IN_VALUES], orderBy)
+            for obj in rs:
+                k = getattr(obj, self.remote)
+                if self.many:
+                    found.setdefault(k, []).append(obj)
+                else:
+                    found[k] = obj
+        for obj in objs:
+            k = getattr(obj, self.local, None)
+            if self.many:
+                setattr(obj, self.name, list(found.get(k, ())))
+            else:
+                setattr(obj, self.name, found.get(k, None))
+        return objs
+
+# 一条in查询中最多的值的个数,超过时分成多条查询
+MAX_IN_VALUES = 512
+
+# 所有模型,按类名索引,用于解析references中的类名
+_models = dict()
+# 每个模型的关系,第一次使用时才建立,因为references可以引用之后才定义的模型
+_relations = dict()
+
+def _resolve_model(ref):
+    if isinstance(ref, str):
+        try:
+            return _models[ref]
+        except KeyError:
+            raise ValueError('Unknown model: %s' % ref)
+    return ref
+
+# 返回{关系名: Relation},包括本模型引用其他模型的关系和其他模型引用本模型的关系
+def _model_relations(cls):
+    relations = _relations.get(cls, None)
+    if relations is not None:
+        return relations
+    relations = dict()
+    def add(relation):
+        if relation.name in cls.__mappings__ or relation.name in relations:
+            raise ValueError('Duplicate relation for %s: %s' % (cls.__name__, relation.name))
+        relations[relation.name] = relation
+    for k, f in cls.__mappings__.items():
+        if f.references is not None and k.endswith('_id'):
+            target = _resolve_model(f.references)
+            add(Relation(k[:-3], target, k, target.__primary_key__, False))
+    for model in list(_models.values()):
+        for k, f in model.__mappings__.items():
+            if f.references is not None and _resolve_model(f.references) is cls:
+                add(Relation(f.related_name or model.__table__, model, cls.__primary_key__, k, True))
+    _relations[cls] = relations
+    return relations
 
 
 # 这是个元类,它定义了如果构造一个类,任何定义了__metaclass__属性或指定metaclass的都会通过元类定义的构造方法构造类
@@ -179,29 +1536,151 @@ class ModelMetaclass(type):
         # 此处利用create_args_string生成若干个?占位
         # 插入数据库时,要指定表名
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' %  (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+        # 批量插入时使用的前缀和单行占位符,多行insert语句由save_many按行数拼接
+        attrs['__insert_prefix__'] = 'insert into `%s` (%s, `%s`) values' % (tableName, ', '.join(escaped_fields), primaryKey)
+        attrs['__insert_row__'] = '(%s)' % create_args_string(len(escaped_fields) + 1)
         # 通过主键查找到记录并更新
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?'%(mappings.get(f).name or f), fields)), primaryKey)
         # 通过主键删除
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        # __cache__为True或缓存的秒数时,这个模型的查询结果会被缓存,见ResultCache
+        cache = attrs.get('__cache__', None)
+        attrs['__cache__'] = DEFAULT_CACHE_TTL if cache is True else (cache or None)
+        # __batch__为True时,同一轮事件循环中的find()合并为一条in查询,见BatchLoader
+        attrs['__batch__'] = bool(attrs.get('__batch__', False))
+        # 每个模型都是一个使用__slots__的紧凑记录类:每一列对应一个槽,属性访问直接走槽描述符
+        # 不再像dict那样为每个对象保存一张哈希表,也不再经过__getattr__和try/except
+        # 额外的'__dict__'槽用于保存非列的临时属性(例如handlers中的html_content),只在第一次使用时才分配
+        attrs['__columns__'] = tuple([primaryKey] + fields)
+        # '__loaded__'槽保存从数据库加载时各列的值,update时据此只写入修改过的列
+        attrs['__slots__'] = attrs['__columns__'] + ('__loaded__', '__dict__')
+        # 索引:列上声明的index/unique,以及__indexes__(普通)和__unique_indexes__(唯一)中的多列索引,例如
+        #   __indexes__ = [('blog_id', 'created_at')]
+        # 保存为[(索引名, 列的元组, 是否唯一), ...],索引名为'idx_'加上各列名
+        indexes = []
+        for k in attrs['__columns__']:
+            f = mappings[k]
+            if (f.index or f.unique) and not f.primary_key:
+                indexes.append(('idx_%s' % k, (k,), bool(f.unique)))
+        declared = [(c, False) for c in attrs.get('__indexes__', ())] + [(c, True) for c in attrs.get('__unique_indexes__', ())]
+        for columns, unique in declared:
+            columns = tuple(columns)
+            for c in columns:
+                if c not in mappings:
+                    raise ValueError('Invalid index column for %s:%s' % (name, c))
+            indexes.append(('idx_%s' % '_'.join(columns), columns, unique))
+        attrs['__index_defs__'] = indexes
+        # toDict()中转换为字符串的列(BigIntField)
+        attrs['__str_columns__'] = frozenset([k for k in attrs['__columns__'] if isinstance(mappings[k], BigIntField)])
+        # toDict()中不输出真实值的列,例如User的passwd;对象本身不修改,同一请求中(标识映射)共享的对象仍保留真实值
+        attrs['__hidden__'] = frozenset(attrs.get('__hidden__', ()))
+        # 建表语句,格式与schema.sql相同(mysql),其他数据库由backend的schema_statements转换
+        lines = ['    `%s` %s not null' % (k, mappings[k].column_type) for k in attrs['__columns__']]
+        lines.extend(['    %skey `%s` (%s)' % ('unique ' if u else '', n, ', '.join(map(lambda c: '`%s`' % c, cols))) for n, cols, u in indexes])
+        lines.append('    primary key (`%s`)' % primaryKey)
+        attrs['__create_table__'] = 'create table `%s` (\n%s\n) engine=innodb default charset=utf8' % (tableName, ',\n'.join(lines))
+        # 在已有的表上单独建立各个索引的语句,用于补上缺少的索引,见missing_indexes
+        attrs['__create_indexes__'] = dict([(n, 'create %sindex `%s` on `%s` (%s)' % ('unique ' if u else '', n, tableName, ', '.join(map(lambda c: '`%s`' % c, cols)))) for n, cols, u in indexes])
+        model = type.__new__(cls, name, bases, attrs)
+        # 各列的槽描述符的__set__,按__columns__的顺序排列;默认的select语句也按这个顺序查询各列,
+        # 因此查询到的元组可以直接逐个赋值,不需要先构造dict再调用__init__(**row),见Model._loadTuples
+        model.__setters__ = tuple([model.__dict__[k].__set__ for k in model.__columns__])
+        # 登记模型,新的模型可能带来新的反向关系,因此清空已建立的关系
+        _models[name] = model
+        _relations.clear()
+        return model
+
+# 模型设置__cache__ = True时使用的缓存时间(秒)
+DEFAULT_CACHE_TTL = 60
+
+# ORM映射基类,通过ModelMetaclass元类来构造类
+# 子类的每一列都是一个__slots__槽,未赋值的列访问时抛出AttributeError
+class Model(object, metaclass=ModelMetaclass):
 
-# ORM映射基类,继承自dict,通过ModelMetaclass元类来构造类
-class Model(dict, metaclass=ModelMetaclass):
+    __slots__ = ()
 
-    # 初始化函数,调用父类(dict)的方法
     def __init__(self, **kw):
-        super(Model, self).__init__(**kw)
+        for k, v in kw.items():
+            setattr(self, k, v)
 
-    # 增加__getatrr__方法,使获取属性更方便,即可通过"a.b"的形式
+    # 只有在正常的属性查找失败时才会调用,不影响已赋值的列的访问速度
+    # 未赋值的列通常是查询时被columns/defer排除的列,需要先通过load()加载
     def __getattr__(self, key):
+        if key in self.__mappings__:
+            raise AttributeError(r"'%s' object has not loaded column '%s', use 'yield from obj.load()' first" % (self.__class__.__name__, key))
+        if not key.startswith('_') and key in _model_relations(self.__class__):
+            raise AttributeError(r"'%s' object has not loaded relation '%s', use findAll(prefetch=['%s']) first" % (self.__class__.__name__, key, key))
+        raise AttributeError(r"'%s' object has no attribute '%s'" % (self.__class__.__name__, key))
+
+    # 返回尚未赋值(未加载)的列
+    def unloadedFields(self):
+        return [k for k in self.__columns__ if not hasattr(self, k)]
+
+    @asyncio.coroutine
+    def load(self, *fields):
+        ' load deferred columns by primary key. '
+        # 不指定fields时加载所有未加载的列,已修改过的列不会被覆盖
+        if not fields:
+            fields = self.unloadedFields()
+        fields = tuple(fields)
+        if not fields:
+            return self
+        cls = self.__class__
+        sql = _statements.get((cls, 'load', fields), lambda: 'select %s from `%s` where `%s`=?' % (
+            ', '.join(map(lambda f: '`%s`' % f, fields)), cls.__table__, cls.__primary_key__))
+        rs = yield from select(sql, [self.getValue(self.__primary_key__)], 1, cls.__table__, cls.__cache__)
+        if len(rs) == 0:
+            logging.warn('failed to load columns by primary key: %s' % self.getValue(self.__primary_key__))
+            return self
+        self._fill(rs[0], fields)
+        return self
+
+    # 用查询到的一行给fields中的列赋值
+    def _fill(self, row, fields):
+        loaded = getattr(self, '__loaded__', None)
+        if loaded is not None:
+            loaded = list(loaded)
+        for k in fields:
+            setattr(self, k, row[k])
+            if loaded is not None:
+                # 同时更新快照中这些列的值,刚加载的列不算作修改过的列
+                loaded[self.__columns__.index(k)] = row[k]
+        if loaded is not None:
+            self.__loaded__ = tuple(loaded)
+
+    # 保留按键访问的方式,兼容之前Model继承自dict时的用法
+    def __getitem__(self, key):
         try:
-            return self[key]
-        except KeyError:
-            raise AttributeError(r"'Model' object has no attribute  '%s'" % key)
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
 
-    # 增加__setatrr__方法,是设置属性更方便,可通过"a.b=c"的形式
-    def __setattr__(self, key, value):
-        self[key] = value
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    # 转换为dict,包括已赋值的列和临时属性,用于json序列化
+    def toDict(self):
+        d = dict()
+        strs = self.__str_columns__
+        hidden = self.__hidden__
+        for k in self.__columns__:
+            try:
+                v = getattr(self, k)
+            except AttributeError:
+                continue
+            if k in hidden:
+                v = '******'
+            elif v is not None and k in strs:
+                v = str(v)
+            d[k] = v
+        d.update(self.__dict__)
+        return d
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.toDict())
 
     # 通过键取值,若值不存在,返回None
     def getValue(self, key):
@@ -223,84 +1702,474 @@ class Model(dict, metaclass=ModelMetaclass):
                 setattr(self, key, value)
         return value
 
+    # 由数据库返回的一行构造对象,并记下此时各列的值
+    @classmethod
+    def _load(cls, row):
+        obj = cls(**row)
+        obj._snapshot()
+        return obj
+
+    # 由查询到的元组构造对象,columns为元组中各列的名称(__columns__或它的子集,顺序与__columns__相同)
+    @classmethod
+    def _loadTuples(cls, rs, columns):
+        new = object.__new__
+        objs = []
+        if columns == cls.__columns__:
+            setters = cls.__setters__
+            for row in rs:
+                obj = new(cls)
+                for setter, value in zip(setters, row):
+                    setter(obj, value)
+                # 元组本身就是按__columns__排列的快照
+                obj.__loaded__ = tuple(row)
+                objs.append(obj)
+            return objs
+        # 只查询了部分列时,未查询的列不赋值,快照中对应的值为None
+        setters = [cls.__dict__[k].__set__ for k in columns]
+        positions = [cls.__columns__.index(k) for k in columns]
+        empty = [None] * len(cls.__columns__)
+        for row in rs:
+            obj = new(cls)
+            loaded = list(empty)
+            for setter, i, value in zip(setters, positions, row):
+                setter(obj, value)
+                loaded[i] = value
+            obj.__loaded__ = tuple(loaded)
+            objs.append(obj)
+        return objs
+
+    # 记下各列当前的值,作为之后判断哪些列被修改过的依据
+    def _snapshot(self):
+        self.__loaded__ = tuple([getattr(self, k, None) for k in self.__columns__])
+
+    # 返回自加载(或上次保存)以来被修改过的非主键列;不是从数据库加载的对象返回全部非主键列
+    def dirtyFields(self):
+        loaded = getattr(self, '__loaded__', None)
+        if loaded is None:
+            return list(self.__fields__)
+        dirty = []
+        # __columns__的第一列是主键,其余列与__fields__顺序相同
+        for k, old in zip(self.__fields__, loaded[1:]):
+            if getattr(self, k, None) != old:
+                dirty.append(k)
+        return dirty
+
+    # 按(模型, where, orderBy, limit形态, seek方向)从语句缓存中取出select语句,未命中时才拼接
+    # limit形态只区分"无","单个数字"和"(offset, limit)"三种,具体数值仍然通过args传入
+    # seek为'after'或'before'时,表示按orderBy中的列做键集(keyset)分页,见_seek_where
+    @classmethod
+    def _select_sql(cls, where=None, orderBy=None, limit=None, seek=None, columns=None):
+        if limit is None:
+            shape = None
+        elif isinstance(limit, int):
+            shape = 1
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            shape = 2
+        else:
+            raise ValueError('Invalid limit value:%s' % str(limit))
+        def build():
+            if columns is None:
+                sql = [cls.__select__]
+            else:
+                sql = ['select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, columns)), cls.__table__)]
+            w, o = where, orderBy
+            if seek:
+                w, o = _seek_where(where, orderBy, seek)
+            # 我们定义的默认的select语句中是通过主键查找的,并不包含where子句
+            # 因此若指定有where,需要在select语句中追加关键字
+            if w:
+                sql.append('where')
+                sql.append(w)
+            if o:
+                sql.append('order by')
+                sql.append(o)
+            if shape == 1:
+                sql.append('limit ?')
+            elif shape == 2:
+                sql.append('limit ?, ?')
+            return ' '.join(sql)
+        return _statements.get((cls, 'select', where, orderBy, shape, seek, columns), build)
+
+    # 根据columns(只查询这些列)或defer(不查询这些列)计算需要查询的列,主键总是会被查询
+    # 返回None表示查询全部列
+    @classmethod
+    def _projection(cls, columns=None, defer=None):
+        if columns is None and defer is None:
+            return None
+        for k in list(columns or []) + list(defer or []):
+            if k not in cls.__mappings__:
+                raise ValueError('Invalid column for %s:%s' % (cls.__name__, k))
+        selected = tuple([k for k in cls.__columns__ if k == cls.__primary_key__
+            or ((columns is None or k in columns) and (defer is None or k not in defer))])
+        if len(selected) == len(cls.__columns__):
+            return None
+        return selected
+
+    # findAll和iter_all共用:根据where和关键字参数构造select语句和参数
+    # 关键字参数after/before为orderBy各列的值(例如(created_at, id)),用于键集分页:
+    #   after: 取排在这些值之后的记录,用于"下一页"
+    #   before: 取排在这些值之前的记录,用于"上一页",返回结果仍按orderBy的顺序排列
+    # 与limit=(offset, limit)不同,键集分页不需要mysql扫描并丢弃前offset行,第500页和第1页的代价相同
+    # 关键字参数columns/defer用于只查询部分列,例如列表页不需要blog的content(mediumtext):
+    #   Blog.findAll(orderBy='created_at desc', defer=['content'])
+    # 未查询的列在需要时通过"yield from obj.load()"再加载
+    @classmethod
+    def _select(cls, where, args, kw):
+        args = list(args) if args else []
+        # 接受同为where,此处orderBy通过关键字参数传入
+        orderBy = kw.get('orderBy', None)
+        limit = kw.get('limit', None)
+        after = kw.get('after', None)
+        before = kw.get('before', None)
+        seek = None
+        if after is not None and before is not None:
+            raise ValueError('Cannot use both after and before.')
+        if after is not None or before is not None:
+            seek = 'after' if after is not None else 'before'
+            if isinstance(limit, tuple):
+                raise ValueError('Invalid limit value for %s:%s' % (seek, str(limit)))
+            values = after if after is not None else before
+            if not orderBy or len(values) != orderBy.count(',') + 1:
+                raise ValueError('%s must match columns of orderBy:%s' % (seek, orderBy))
+            args.extend(_seek_args(values))
+        columns = cls._projection(kw.get('columns', None), kw.get('defer', None))
+        sql = cls._select_sql(where, orderBy, limit, seek, columns)
+        if isinstance(limit, int):
+            args.append(limit)
+        elif limit is not None:
+            args.extend(limit)
+        return sql, args, seek, columns or cls.__columns__
+
+    # 由查询结果构造对象,已经在本次请求中加载过的主键,使用标识映射中的对象
+    # columns不为None时,rs中的每一行是按columns排列的元组
+    @classmethod
+    def _hydrate(cls, rs, columns=None):
+        if columns is None:
+            objs = [cls._load(r) for r in rs]
+        else:
+            objs = cls._loadTuples(rs, columns)
+        identity_map = current_identity_map()
+        if identity_map is None:
+            return objs
+        result = []
+        for obj in objs:
+            mapped = identity_map.add(obj)
+            if mapped is not obj:
+                # 映射中已有的对象可能只加载了部分列(defer/columns),用这次查询到的列补齐
+                fields = [k for k in mapped.unloadedFields() if hasattr(obj, k)]
+                if fields:
+                    mapped._fill(dict([(k, getattr(obj, k)) for k in fields]), fields)
+            result.append(mapped)
+        return result
+
+    # 关键字参数raw为True时直接返回查询到的行(dict),不构造模型对象,也不进入标识映射,适合只读的列表和json接口
+    # 这些行可能来自结果缓存,是只读的,不能修改
+    # 关键字参数prefetch为要一并加载的关系,每个关系只多一条in查询,而不是每个对象一条查询:
+    #   Blog.findAll(orderBy='created_at desc', limit=10, prefetch=['user', ('comments', 'created_at desc')])
+    # 元组的第二项为关联对象的排序
     @classmethod  # 该装饰器将方法定义为类方法
     @asyncio.coroutine
     def findAll(cls, where=None, args=None, **kw):
         ' find objects by where clause.'
-        sql = [cls.__select__]
-        # 我们定义的默认的select语句中是通过主键查找的,并不包含where子句
-        # 因此若指定有where,需要在select语句中追加关键字
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
-        # 接受同为where,此处orderBy通过关键字参数传入
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
+        sql, args, seek, columns = cls._select(where, args, kw)
+        raw = kw.get('raw', False)
+        prefetch = kw.get('prefetch', None)
+        if raw and prefetch:
+            raise ValueError('Cannot use prefetch with raw rows.')
+        # 按元组查询,由_loadTuples直接构造对象
+        rs = yield from select(sql, args, None, cls.__table__, cls.__cache__, not raw, kw.get('timeout', None)) # 没有指定size,因此会fetchall
+        if seek == 'before':
+            # before是按相反的顺序查询的,这里再翻转回orderBy的顺序
+            rs = list(reversed(rs))
+        if raw:
+            return list(rs)
+        objs = cls._hydrate(rs, columns)
+        if prefetch:
+            yield from cls.prefetch(objs, *prefetch)
+        return objs
 
-        limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value:%s' % str(limit))
-        rs = yield from select(' '.join(sql), args) # 没有指定size,因此会fetchall
-        return [cls(**r) for r in rs]
+    @classmethod
+    @asyncio.coroutine
+    def prefetch(cls, objs, *relations):
+        ' load relations of objs, one query per relation. '
+        for name in relations:
+            orderBy = None
+            if isinstance(name, tuple):
+                name, orderBy = name
+            relation = _model_relations(cls).get(name, None)
+            if relation is None:
+                raise ValueError('Unknown relation for %s:%s' % (cls.__name__, name))
+            yield from relation.load(objs, orderBy)
+        return objs
+
+    # 查询column的值在keys中的对象
+    @classmethod
+    @asyncio.coroutine
+    def _findIn(cls, column, keys, orderBy=None):
+        rs = yield from cls._selectIn(column, keys, orderBy, True)
+        return cls._hydrate(rs, cls.__columns__)
+
+    # 查询column的值在keys中的行
+    # 占位符的个数向上取为2的幂,不足的部分重复最后一个值,这样每一列的in查询只会生成少数几种语句
+    @classmethod
+    @asyncio.coroutine
+    def _selectIn(cls, column, keys, orderBy=None, tuples=False):
+        n = 1
+        while n < len(keys):
+            n = n * 2
+        def build():
+            sql = '%s where `%s` in (%s)' % (cls.__select__, column, create_args_string(n))
+            if orderBy:
+                sql = '%s order by %s' % (sql, orderBy)
+            return sql
+        sql = _statements.get((cls, 'in', column, n, orderBy), build)
+        args = list(keys) + [keys[-1]] * (n - len(keys))
+        return (yield from select(sql, args, None, cls.__table__, cls.__cache__, tuples))
+
+    # 按主键查询行,主键较多时分成多条in查询
+    @classmethod
+    @asyncio.coroutine
+    def _findRows(cls, keys):
+        rows = []
+        for i in range(0, len(keys), MAX_IN_VALUES):
+            rows.extend((yield from cls._selectIn(cls.__primary_key__, keys[i:i + MAX_IN_VALUES])))
+        return rows
+
+    @classmethod
+    def iter_all(cls, where=None, args=None, batch=500, **kw):
+        ' iterate objects by where clause with a server-side cursor. '
+        # 与findAll参数相同,但返回的是RowIterator,对象按批构造,不会一次性全部载入内存
+        if kw.get('before', None) is not None:
+            raise ValueError('iter_all does not support before.')
+        sql, args, seek, columns = cls._select(where, args, kw)
+        return RowIterator(sql, args, batch, cls._load)
 
     @classmethod
     @asyncio.coroutine
     def findNumber(cls, selectField, where=None, args=None):
         ' find number by select and where. '
-        sql =['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = yield from select(' '.join(sql), args, 1)
+        def build():
+            sql =['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+            if where:
+                sql.append('where')
+                sql.append(where)
+            return ' '.join(sql)
+        sql = _statements.get((cls, 'number', selectField, where), build)
+        rs = yield from select(sql, args, 1, cls.__table__, cls.__cache__)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
 
+    @classmethod
+    @asyncio.coroutine
+    def countAll(cls, where=None, args=None):
+        ' count rows by where clause, kept in memory by CountCache. '
+        # 写入后需要读主库的请求不使用缓存,计数直接在主库上查询
+        if _reads_primary():
+            return (yield from cls.findNumber('count(*)', where, args))
+        key = _counts.key(cls.__table__, where, args)
+        n = _counts.get(key)
+        if n is not None:
+            return n
+        generation = _counts.generation(cls.__table__)
+        if where is None and _counts.approximate and _backend.table_rows_sql:
+            # 先查看统计信息中的行数,表足够大时直接使用这个近似值,不再做全索引扫描
+            rs = yield from select(_backend.table_rows_sql, [cls.__table__], 1)
+            if len(rs) > 0 and rs[0]['_num_'] is not None and rs[0]['_num_'] >= _counts.approximate:
+                n = rs[0]['_num_']
+        if n is None:
+            n = yield from cls.findNumber('count(*)', where, args)
+        _counts.put(key, n, generation, _replica_lag())
+        return n
+
     @classmethod
     @asyncio.coroutine
     def find(cls, pk):
         ' find object by primary key. '
-        # 我们之前已将将数据库的select操作封装在select函数中,以下select的参数依次就是sql, args, size
-        rs = yield from select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-        if len(rs) == 0:
+        try:
+            pk = cls.__mappings__[cls.__primary_key__].convert(pk)
+        except ValueError:
+            # 不合法的主键(例如整数主键的url中不是数字),不可能存在
+            return None
+        identity_map = current_identity_map()
+        if identity_map is not None:
+            obj = identity_map.get(cls, pk)
+            if obj is not None:
+                # 映射中的对象可能是只查询了部分列得到的,此时补齐其余的列
+                if obj.unloadedFields():
+                    yield from obj.load()
+                return obj
+        if cls.__batch__ and current_transaction() is None and not _reads_primary():
+            # 与同一轮事件循环中的其他find()合并为一条查询,见BatchLoader
+            row = yield from _loader(cls).load(pk)
+        else:
+            # 我们之前已将将数据库的select操作封装在select函数中,以下select的参数依次就是sql, args, size
+            sql = _statements.get((cls, 'find'), lambda: '%s where `%s`=?' % (cls.__select__, cls.__primary_key__))
+            rs = yield from select(sql, [pk], 1, cls.__table__, cls.__cache__)
+            row = rs[0] if rs else None
+        if row is None:
             return None
         # **表示关键字参数; 注意:我们在select函数中,打开的是DictCursor,它会以dict的形式返回结果
-        return cls(**rs[0])
+        obj = cls._load(row)
+        if identity_map is not None:
+            obj = identity_map.add(obj)
+        return obj
+
+    @classmethod
+    @asyncio.coroutine
+    def find_many(cls, pks):
+        ' find objects by primary keys with one query. '
+        # 返回与pks顺序相同的列表,不存在的主键对应None
+        convert = cls.__mappings__[cls.__primary_key__].convert
+        pks = list(pks)
+        found = dict()
+        keys = []
+        for i, pk in enumerate(pks):
+            try:
+                pk = pks[i] = convert(pk)
+            except ValueError:
+                pk = pks[i] = None
+            if pk is not None and pk not in found:
+                found[pk] = None
+                keys.append(pk)
+        identity_map = current_identity_map()
+        if identity_map is not None:
+            missing = []
+            for pk in keys:
+                obj = identity_map.get(cls, pk)
+                if obj is not None and not obj.unloadedFields():
+                    found[pk] = obj
+                else:
+                    missing.append(pk)
+            keys = missing
+        if keys:
+            for row in (yield from cls._findRows(keys)):
+                obj = cls._load(row)
+                if identity_map is not None:
+                    obj = identity_map.add(obj)
+                    # 映射中已有只查询了部分列的对象时,补齐其余的列
+                    unloaded = obj.unloadedFields()
+                    if unloaded:
+                        obj._fill(row, unloaded)
+                found[row[cls.__primary_key__]] = obj
+        return [found.get(pk, None) for pk in pks]
 
+    # on_conflict决定主键或唯一索引重复时的处理,都只需一次往返:
+    #   'error'(默认): 抛出DuplicateKeyError,不需要先查询是否已存在
+    #   'update': 更新已有的记录(insert ... on duplicate key update),update为要更新的列,默认为全部非主键列
+    #             与已有记录冲突的是其他唯一索引时,已有记录的主键不变,可能与这个对象的主键不同
+    #   'ignore': 保留已有的记录,什么也不做;只忽略重复键,其他错误(例如not null)照常抛出
+    # 返回影响的行数:mysql中插入为1,更新为2,记录已存在且没有变化或被忽略时为0(sqlite更新时也为1)
     @asyncio.coroutine 
-    def save(self):
+    def save(self, on_conflict='error', update=None):
         # 我们在定义__insert__时,将主键放在末尾,因为属性与值要一一对应,因此通过append的方式将主键加在最后
-        args = list(map(self.getValueOrDefault, self.__fields__))#使用getValueOrDefault方法,可以调用time.time这样的函数来获取值
-        args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = yield from execute(self.__insert__, args)
-        if rows != 1: #插入一条记录,结果影响的条数不等于1,肯定出错了
+        # 使用getValueOrDefault方法,可以调用time.time这样的函数来获取值
+        if on_conflict == 'error':
+            sql = self.__insert__
+        elif on_conflict == 'ignore':
+            sql = _statements.get((self.__class__, 'insert', 'ignore'), lambda: '%s %s' % (self.__insert__, _backend.ignore_clause(self.__primary_key__)))
+        elif on_conflict == 'update':
+            columns = tuple(update or self.__fields__)
+            for k in columns:
+                if k not in self.__fields__:
+                    raise ValueError('Invalid update column for %s:%s' % (self.__class__.__name__, k))
+            sql = _statements.get((self.__class__, 'insert', 'update', columns), lambda: '%s %s' % (self.__insert__, _backend.upsert_clause(columns)))
+        else:
+            raise ValueError('Invalid on_conflict value:%s' % on_conflict)
+        rows = yield from execute(sql, self._insert_args())
+        if on_conflict == 'ignore' and rows == 0:
+            # 记录已存在,这个对象没有被保存
+            return rows
+        invalidate(self.__table__)
+        if on_conflict == 'update':
+            # 无法可靠地区分插入和更新,直接丢弃这张表的计数
+            _counts.invalidate(self.__table__)
+        elif rows != 1: #插入一条记录,结果影响的条数不等于1,肯定出错了
             logging.warn('failed to insert record: affected rows: %s' % rows)
+            _counts.invalidate(self.__table__)
+        else:
+            _counts.apply(self.__table__, [self], 1)
+        self._snapshot()
+        identity_map = current_identity_map()
+        if identity_map is not None:
+            identity_map.add(self)
+        _notify(self, 'save')
+        return rows
+
+    # 获取插入一行时的参数,主键放在末尾,与__insert__的列顺序一致
+    def _insert_args(self):
+        args = list(map(self.getValueOrDefault, self.__fields__))
+        args.append(self.getValueOrDefault(self.__primary_key__))
+        return args
+
+    @classmethod
+    @asyncio.coroutine
+    def save_many(cls, objs, batch_size=100):
+        ' insert objects by multi-row insert statements. '
+        # 每batch_size行拼成一条"insert ... values (...), (...)"语句,一次往返插入多行
+        # batch_size用于控制单条语句的大小,避免超过mysql的max_allowed_packet
+        if batch_size < 1:
+            raise ValueError('Invalid batch_size value:%s' % str(batch_size))
+        # 允许直接传入dict,统一转换为模型对象,这样每行都能通过getValueOrDefault取到默认值
+        objs = [o if isinstance(o, cls) else cls(**o) for o in objs]
+        affected = 0
+        for i in range(0, len(objs), batch_size):
+            batch = objs[i:i + batch_size]
+            n = len(batch)
+            sql = _statements.get((cls, 'insert', n), lambda: '%s %s' % (cls.__insert_prefix__, ', '.join([cls.__insert_row__] * n)))
+            args = []
+            for obj in batch:
+                args.extend(obj._insert_args())
+            rows = yield from execute(sql, args)
+            invalidate(cls.__table__)
+            if rows != n:
+                logging.warn('failed to insert records: expected rows: %s, affected rows: %s' % (n, rows))
+                _counts.invalidate(cls.__table__)
+            else:
+                _counts.apply(cls.__table__, batch, 1)
+            for obj in batch:
+                obj._snapshot()
+                _notify(obj, 'save')
+            affected = affected + rows
+        return affected
 
     @asyncio.coroutine
     def update(self):
+        # 只更新修改过的列,例如只改了blog的name时,不会把mediumtext的content再传一遍
+        fields = self.dirtyFields()
+        if not fields:
+            # 没有任何修改,不需要访问数据库
+            return
+        if len(fields) == len(self.__fields__):
+            sql = self.__update__
+        else:
+            # 按修改的列的组合缓存update语句
+            fields = tuple(fields)
+            sql = _statements.get((self.__class__, 'update', fields), lambda: 'update `%s` set %s where `%s`=?' % (
+                self.__table__, ', '.join(map(lambda f: '`%s`=?' % (self.__mappings__.get(f).name or f), fields)), self.__primary_key__))
         # 像time.time,next_id之类的函数在插入的时候已经调用过了,没有其他需要实时更新的值,因此调用getValue
-        args = list(map(self.getValue, self.__fields__))
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = yield from execute(self.__update__, args)
+        rows = yield from execute(sql, args)
+        invalidate(self.__table__)
+        _counts.changed(self.__table__, fields)
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
+        self._snapshot()
+        _notify(self, 'update', tuple(fields))
 
     @asyncio.coroutine
     def remove(self):
         args = [self.getValue(self.__primary_key__)]  # 取消主键做为参数
         rows = yield from execute(self.__delete__, args)   # 调用默认的Delete语句
+        invalidate(self.__table__)
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
+            _counts.invalidate(self.__table__)
+        else:
+            _counts.apply(self.__table__, [self], -1)
+        identity_map = current_identity_map()
+        if identity_map is not None:
+            identity_map.remove(self)
+        _notify(self, 'remove')
 
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+'''
+Generate the schema from the models, or report indexes declared on the models but missing in the database.
+
+    python3 schema.py             # print create table statements of all models
+    python3 schema.py --missing   # print create index statements for indexes missing in configs.db
+'''
+
+import argparse, asyncio
+
+import orm
+import Models
+from config import configs
+
+@asyncio.coroutine
+def report(loop):
+    yield from orm.create_pool(loop=loop, **configs.db)
+    try:
+        missing = yield from orm.missing_indexes()
+    finally:
+        yield from orm.close_pool()
+    for model, sql in missing:
+        print('%s;' % sql)
+    return missing
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Schema of the models.')
+    parser.add_argument('--missing', action='store_true', help='report indexes missing in the database')
+    args = parser.parse_args()
+    if args.missing:
+        loop = asyncio.get_event_loop()
+        missing = loop.run_until_complete(report(loop))
+        exit(1 if missing else 0)
+    for sql in orm.schema_statements():
+        print('%s;\n' % sql)
@@ -8,6 +8,9 @@ use awesome;
 grant select, insert, update, delete on awesome.* to 'www-data'@'localhost' identified by 'www-data';
 
 
+-- 主键和引用主键的列为varchar(50)的字符串(configs.ids.type为string);
+-- 使用64位整数主键(configs.ids.type为bigint)的数据库用schema.py生成的建表语句建表
+
 create table users(
     `id` varchar(50) not null,
     `email` varchar(50) not null,
@@ -43,5 +46,6 @@ create table comments (
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
\ No newline at end of file
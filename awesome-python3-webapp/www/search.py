@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+
+'''
+In-process full-text search over blogs: an inverted index with BM25 ranking.
+'''
+
+# 倒排索引:词 -> {日志id: 词频},另外保存每篇日志的长度(词数),查询时按BM25打分
+# 正排索引:日志id -> 它包含的词,删除或替换一篇日志时只需处理它自己的词,不需要遍历整个词表
+# 分词:连续的字母数字为一个词(转为小写);中日韩文字没有空格分隔,按相邻两个字(bigram)切分,
+# 同时保留单字,这样单字的查询也能命中;查询时多于一个字的部分只使用bigram
+# 启动时从文件载入索引,与blogs表中的id对账(补上新增的,去掉已删除的),没有文件时遍历整张表建立
+# 之后通过orm.listen在Blog的save/update/remove之后增量更新,并定期写回文件
+# 每次修改同时把日志id追加到日志文件(索引文件名加.journal),写回文件后截掉已包含在其中的部分;
+# 进程未能写回文件就退出时(崩溃,kill -9),下次启动对账时重新索引日志文件中的日志,修改过的内容不会丢失
+# 注意:索引在每个进程的内存中,其他进程对blogs的修改只在下次启动对账时补上新增和删除的日志
+
+import array, asyncio, atexit, heapq, logging, marshal, math, operator, os, re, signal, sys, zlib
+from collections import Counter
+from itertools import accumulate
+
+import orm
+from Models import Blog
+
+_RE_CJK = r'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+_RE_TOKEN = re.compile(r'[%s]+|[^\W_%s]+' % (_RE_CJK, _RE_CJK))
+_RE_IS_CJK = re.compile(r'[%s]' % _RE_CJK)
+
+# 过长的"词"(例如base64,url)没有检索价值,直接丢弃
+MAX_WORD = 40
+
+# 把文本切分为词的列表,query为True时按查询的方式切分(多字的中日韩文字只使用bigram)
+def tokenize(text, query=False):
+    tokens = []
+    for m in _RE_TOKEN.finditer(text.lower()):
+        w = m.group()
+        if not _RE_IS_CJK.match(w):
+            if len(w) <= MAX_WORD:
+                tokens.append(w)
+            continue
+        if len(w) == 1:
+            tokens.append(w)
+            continue
+        if not query:
+            tokens.extend(w)
+        tokens.extend([w[i:i + 2] for i in range(len(w) - 1)])
+    return tokens
+
+class SearchIndex(object):
+
+    # k1控制词频的饱和速度,b控制按文档长度归一化的程度,取BM25常用的值
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = dict()
+        self._lengths = dict()
+        self._terms = dict()
+        self._total = 0
+        # 自上次写入文件后是否有修改
+        self.dirty = False
+        # 修改开始和结束时各加1,修改进行中为奇数,见snapshot
+        self._version = 0
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def __contains__(self, key):
+        return key in self._lengths
+
+    def keys(self):
+        return list(self._lengths)
+
+    # 添加或替换一篇文档
+    def add(self, key, text):
+        self._version = self._version + 1
+        if key in self._lengths:
+            self.remove(key)
+        tokens = tokenize(text)
+        terms = []
+        for term, tf in Counter(tokens).items():
+            # 词在正排和倒排索引中共用同一个字符串对象
+            term = sys.intern(term)
+            postings = self._postings.get(term, None)
+            if postings is None:
+                postings = self._postings[term] = dict()
+            postings[key] = tf
+            terms.append(term)
+        self._terms[key] = tuple(terms)
+        self._lengths[key] = len(tokens)
+        self._total = self._total + len(tokens)
+        self.dirty = True
+        self._version = self._version + 1
+
+    # 删除一篇文档,代价与这篇文档的词数成正比
+    def remove(self, key):
+        if key not in self._lengths:
+            return
+        self._version = self._version + 1
+        self._total = self._total - self._lengths.pop(key)
+        for term in self._terms.pop(key):
+            postings = self._postings[term]
+            del postings[key]
+            if not postings:
+                del self._postings[term]
+        self.dirty = True
+        self._version = self._version + 1
+
+    # 返回(匹配的文档总数, [(key, score), ...]),结果按得分从高到低排列,得分相同时新的文档(id较大)在前
+    def search(self, query, offset=0, limit=10):
+        n = len(self._lengths)
+        if n == 0:
+            return 0, []
+        k1, b = self.k1, self.b
+        avgdl = self._total / n or 1.0
+        lengths = self._lengths
+        scores = dict()
+        for term, qtf in Counter(tokenize(query, query=True)).items():
+            postings = self._postings.get(term, None)
+            if not postings:
+                continue
+            idf = math.log(1.0 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for key, tf in postings.items():
+                s = qtf * idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[key] / avgdl))
+                scores[key] = scores.get(key, 0.0) + s
+        if offset >= len(scores) or limit <= 0:
+            return len(scores), []
+        top = heapq.nlargest(offset + limit, scores.items(), key=lambda kv: (kv[1], kv[0]))
+        return len(scores), top[offset:]
+
+    # 文件格式:MAGIC,一个字节的版本,之后是zlib压缩的marshal数据:
+    #   (字节序, [key, ...], 各文档长度, [词, ...], 各词的文档数, 文档序号的差值, 词频)
+    # 后四项为整个索引共用的array,每个词的文档序号递增排列并保存差值,压缩后每个(词, 文档)通常只占一两个字节
+    # 载入时只需按顺序切分这几个array,不需要逐条解析
+    MAGIC = b'AWSI'
+    VERSION = 1
+
+    def dumps(self):
+        keys = list(self._lengths)
+        numbers = dict([(k, i) for i, k in enumerate(keys)])
+        terms = list(self._postings)
+        counts = array.array('I')
+        deltas = array.array('I')
+        tfs = array.array('I')
+        number = numbers.__getitem__
+        for term in terms:
+            # 每个词的文档与_lengths一样按加入的先后排列(替换时先删除再加到末尾),因此序号已经递增,不需要排序
+            postings = self._postings[term]
+            docs = list(map(number, postings))
+            counts.append(len(docs))
+            deltas.extend(map(operator.sub, docs, [0] + docs[:-1]))
+            tfs.extend(postings.values())
+        lengths = array.array('I', [self._lengths[k] for k in keys])
+        return marshal.dumps((sys.byteorder, keys, lengths.tobytes(), terms, counts.tobytes(), deltas.tobytes(), tfs.tobytes()))
+
+    @classmethod
+    def loads(cls, data, **kw):
+        byteorder, keys, lengths, terms, counts, deltas, tfs = marshal.loads(data)
+        def unpack(b):
+            a = array.array('I')
+            a.frombytes(b)
+            if byteorder != sys.byteorder:
+                a.byteswap()
+            return a
+        index = cls(**kw)
+        lengths = unpack(lengths)
+        index._lengths = dict(zip(keys, lengths))
+        index._total = sum(lengths)
+        deltas, tfs = unpack(deltas), unpack(tfs)
+        key = keys.__getitem__
+        i = 0
+        for term, n in zip(map(sys.intern, terms), unpack(counts)):
+            index._postings[term] = dict(zip(map(key, accumulate(deltas[i:i + n])), tfs[i:i + n]))
+            i = i + n
+        # 正排索引不保存在文件中,由倒排索引重建
+        forward = dict([(k, []) for k in keys])
+        for term, postings in index._postings.items():
+            for k in postings:
+                forward[k].append(term)
+        index._terms = dict([(k, tuple(v)) for k, v in forward.items()])
+        return index
+
+    # 序列化索引,可以在线程池中调用,不阻塞事件循环(大的索引需要数秒)
+    # 期间索引被修改时(版本号变化,或遍历时字典大小改变)返回None,由调用者稍后重试
+    def snapshot(self):
+        version = self._version
+        if version % 2:
+            return None
+        try:
+            data = self.dumps()
+        except (RuntimeError, KeyError):
+            return None
+        if self._version != version:
+            return None
+        return data
+
+    # 写入文件:先写临时文件再改名,写到一半的文件不会替换原来的索引
+    def save(self, path, data=None):
+        data = zlib.compress(data if data is not None else self.dumps(), 6)
+        tmp = '%s.tmp' % path
+        with open(tmp, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(bytes([self.VERSION]))
+            f.write(data)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, **kw):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:len(cls.MAGIC)] != cls.MAGIC or data[len(cls.MAGIC)] != cls.VERSION:
+            raise ValueError('Invalid search index file: %s' % path)
+        return cls.loads(zlib.decompress(data[len(cls.MAGIC) + 1:]), **kw)
+
+# Blog中参与检索的列,标题重复一次,使标题中的词得分更高
+INDEXED_FIELDS = ('name', 'summary', 'content')
+
+def blog_text(blog):
+    return '\n'.join([blog.name or '', blog.name or '', blog.summary or '', blog.content or ''])
+
+_index = None
+_file = None
+_saver = None
+
+# 启动时调用:载入或建立索引,开始监听Blog的写入
+#   file: 索引文件,None表示不保存,每次启动都重新建立
+#   save_interval: 有修改时每隔多少秒写回文件
+@asyncio.coroutine
+def setup(loop, file=None, save_interval=300):
+    global _index, _file, _saver
+    _file = file
+    index = None
+    if file and os.path.exists(file):
+        try:
+            index = yield from loop.run_in_executor(None, SearchIndex.load, file)
+        except Exception as e:
+            logging.warning('failed to load search index %s: %s' % (file, e))
+    # 先开始监听,建立索引期间发生的写入也会反映到索引中
+    _index = index or SearchIndex()
+    orm.listen(Blog, _on_change)
+    if index is None:
+        yield from build(_index)
+    else:
+        yield from reconcile(index)
+    index = _index
+    logging.info('search index ready: %d blogs.' % len(index))
+    if file:
+        atexit.register(save)
+        # 默认的SIGTERM直接结束进程,不会执行atexit;改为停止事件循环,正常退出时写回文件
+        try:
+            loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        except (NotImplementedError, RuntimeError):
+            pass
+        if save_interval:
+            _saver = asyncio.ensure_future(_save_periodically(loop, save_interval))
+    return index
+
+# 遍历blogs表建立索引,使用流式查询,不会一次性载入所有日志
+@asyncio.coroutine
+def build(index=None):
+    index = index if index is not None else SearchIndex()
+    it = Blog.iter_all(columns=INDEXED_FIELDS)
+    try:
+        while True:
+            blogs = yield from it.fetch()
+            if not blogs:
+                break
+            for blog in blogs:
+                index.add(blog.id, blog_text(blog))
+    finally:
+        yield from it.close()
+    return index
+
+# 与blogs表中的id对账:补上文件保存之后新增的日志,去掉已删除的,并重新索引日志文件中记录的被修改过的日志
+@asyncio.coroutine
+def reconcile(index, batch=500):
+    rs = yield from orm.select('select `%s` from `%s`' % (Blog.__primary_key__, Blog.__table__), [], tuples=True)
+    ids = set([r[0] for r in rs])
+    for key in index.keys():
+        if key not in ids:
+            index.remove(key)
+    changed = set([k for k in _read_journal() if k in ids])
+    missing = [k for k in ids if k not in index or k in changed]
+    for i in range(0, len(missing), batch):
+        for blog in (yield from Blog.find_many(missing[i:i + batch])):
+            if blog is not None:
+                index.add(blog.id, blog_text(blog))
+
+def _on_change(action, blog, fields):
+    if _index is None:
+        return
+    if action == 'remove':
+        _index.remove(blog.id)
+        return
+    if fields is not None and not set(fields) & set(INDEXED_FIELDS):
+        return
+    _append_journal(blog.id)
+    if set(blog.unloadedFields()) & set(INDEXED_FIELDS):
+        # 对象只加载了部分列(例如defer=['content']),重新查询整篇日志
+        asyncio.ensure_future(_reindex(blog.id))
+        return
+    _index.add(blog.id, blog_text(blog))
+
+@asyncio.coroutine
+def _reindex(key):
+    blog = yield from Blog.find(key)
+    if blog is None:
+        _index.remove(key)
+    else:
+        _index.add(key, blog_text(blog))
+        # 查询期间索引可能已写回文件并截掉了这个id,再记录一次,直到包含这次修改的索引写回文件
+        _append_journal(key)
+
+# 返回(匹配的日志总数, [(日志id, 得分), ...])
+def query(q, offset=0, limit=10):
+    if _index is None:
+        raise RuntimeError('search index is not ready.')
+    return _index.search(q, offset, limit)
+
+# 同步写回文件,进程退出时调用
+def save():
+    if _index is not None and _file and _index.dirty:
+        mark = _journal_size()
+        _index.save(_file)
+        _index.dirty = False
+        _trim_journal(mark)
+
+@asyncio.coroutine
+def _save_periodically(loop, interval):
+    while True:
+        yield from asyncio.sleep(interval)
+        if not _index.dirty:
+            continue
+        _index.dirty = False
+        # 此时日志文件中的修改都已反映在索引中,写回成功后可以截掉
+        mark = _journal_size()
+        try:
+            saved = yield from loop.run_in_executor(None, _write, _index, _file)
+        except Exception as e:
+            saved = False
+            logging.warning('failed to save search index %s: %s' % (_file, e))
+        if saved:
+            _trim_journal(mark)
+        else:
+            _index.dirty = True
+
+# 在线程池中序列化,压缩并写入文件,序列化期间索引被修改时返回False
+def _write(index, path):
+    data = index.snapshot()
+    if data is None:
+        return False
+    index.save(path, data)
+    return True
+
+# 日志文件:每行一个被修改过的日志id,只在事件循环的线程中读写
+def _journal_path():
+    return '%s.journal' % _file if _file else None
+
+def _append_journal(key):
+    path = _journal_path()
+    if path is None:
+        return
+    try:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('%s\n' % key)
+    except OSError as e:
+        logging.warning('failed to write search journal %s: %s' % (path, e))
+
+def _read_journal():
+    path = _journal_path()
+    if path is None or not os.path.exists(path):
+        return []
+    convert = Blog.__mappings__[Blog.__primary_key__].convert
+    keys = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                keys.append(convert(line.strip()))
+            except ValueError:
+                # 最后一行可能只写了一半
+                pass
+    return keys
+
+def _journal_size():
+    path = _journal_path()
+    try:
+        return os.path.getsize(path) if path else 0
+    except OSError:
+        return 0
+
+# 截掉日志文件的前mark个字节(已写回索引文件的修改),保留之后追加的部分
+def _trim_journal(mark):
+    path = _journal_path()
+    if path is None or not mark:
+        return
+    try:
+        with open(path, 'rb') as f:
+            f.seek(mark)
+            rest = f.read()
+        if rest:
+            tmp = '%s.tmp' % path
+            with open(tmp, 'wb') as f:
+                f.write(rest)
+            os.replace(tmp, path)
+        else:
+            os.remove(path)
+    except OSError as e:
+        logging.warning('failed to trim search journal %s: %s' % (path, e))